@@ -0,0 +1,120 @@
+"""
+Beam height and horizontal distance for the lidars. Heights for every range gate of
+every elevation in a scan are done in one go and kept in a small lookup table, so
+scans with the same gates and elevations (which is nearly all of them) don't need
+to recompute them.
+
+Usage:
+    hgt, dist = beam_geometry.lookup(rng, elev)  # (nbeams, nrange) arrays
+"""
+
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+
+Re = 6371000
+R43 = Re * 4.0 / 3.0
+
+# Tables are kept for this many instrument configurations (range gates + elevations)
+TABLE_CACHE_SIZE = 16
+_table_cache = OrderedDict()
+
+
+def ray_height(rng, elev, H0=0, R1=R43):
+    """
+    Center of radar beam height calculation.
+    Rinehart (1997), Eqn 3.12, Bech et al. (2003) Eqn 3
+    rng and elev are broadcast against each other, so an (n, 1) elev and a (nrange,) rng
+    give an (n, nrange) array.
+    :param rng: Range from radar to point of interest [m]
+    :param elev: Elevation angle of radar beam [deg]
+    :param H0: Height of radar antenna [m]
+    :param R1: Effective radius. Defaults to the 4/3 "standard atmosphere" approximation.
+    :return: Beam height [m]
+    """
+    hgt = np.sqrt(rng ** 2 + R1 ** 2 + 2 * rng * R1 * np.sin(np.deg2rad(elev)))
+    hgt = hgt - R1 + H0
+
+    return hgt
+
+
+def ray_distance(rng, elev, H0=0, R1=R43):
+    """
+    Distance along the ground from the radar to the center of the beam.
+    Doviak and Zrnic (1993), Eqn 2.28b. Broadcasts the same way as ray_height.
+    :param rng: Range from radar to point of interest [m]
+    :param elev: Elevation angle of radar beam [deg]
+    :param H0: Height of radar antenna [m]
+    :param R1: Effective radius
+    :return: Horizontal distance [m]
+    """
+    hgt = ray_height(rng, elev, H0=0, R1=R1)
+
+    return R1 * np.arcsin(rng * np.cos(np.deg2rad(elev)) / (R1 + hgt))
+
+
+def _table(rng, elevs, H0, R1):
+    """
+    Returns the (height, distance) table for each of the unique elevations in elevs.
+    Tables are cached by the range gates, elevations and antenna setup.
+    """
+    key = hashlib.sha1(np.ascontiguousarray(rng, dtype=float).tobytes())
+    key.update(np.ascontiguousarray(elevs, dtype=float).tobytes())
+    key = (key.hexdigest(), float(H0), float(R1))
+
+    table = _table_cache.get(key)
+    if table is not None:
+        _table_cache[key] = _table_cache.pop(key)  # Move it to the most recently used spot
+        return table
+
+    elevs = elevs[:, np.newaxis]
+    table = (ray_height(rng, elevs, H0=H0, R1=R1), ray_distance(rng, elevs, H0=H0, R1=R1))
+
+    # Other lookups share these, so make sure nothing changes them in place
+    for arr in table:
+        arr.setflags(write=False)
+
+    _table_cache[key] = table
+    if len(_table_cache) > TABLE_CACHE_SIZE:
+        _table_cache.popitem(last=False)
+
+    return table
+
+
+def lookup(rng, elev, H0=0, R1=R43):
+    """
+    Gets the beam height and horizontal distance of every range gate for each beam
+    :param rng: (nrange,) array of ranges [m]
+    :param elev: Elevation of each beam [deg]. Either one per beam, or (nbeams, nrange) if
+                 the elevation changes along the beam.
+    :param H0: Height of radar antenna [m]
+    :param R1: Effective radius
+    :return:
+    hgt - (nbeams, nrange) array of heights [m]
+    dist - (nbeams, nrange) array of horizontal distances [m]
+    """
+    rng = np.asarray(rng, dtype=float)
+    elev = np.ma.filled(np.ma.asarray(elev, dtype=float), np.nan)
+
+    if elev.ndim > 1:
+        # Nothing to share between beams, so just do it directly
+        return ray_height(rng, elev, H0=H0, R1=R1), ray_distance(rng, elev, H0=H0, R1=R1)
+
+    elevs, beam_ind = np.unique(np.atleast_1d(elev), return_inverse=True)
+    hgt, dist = _table(rng, elevs, H0, R1)
+
+    return hgt[beam_ind], dist[beam_ind]
+
+
+def profile_height(rng, elev, H0=0, R1=R43):
+    """
+    Height of each range gate for a profile made from all the beams in a scan (like a VAD),
+    which is the mean of the beam heights
+    :param rng: (nrange,) array of ranges [m]
+    :param elev: Elevation of each beam [deg], same as lookup
+    :return: (nrange,) array of heights [m]
+    """
+    hgt, dist = lookup(rng, elev, H0=H0, R1=R1)
+
+    return np.nanmean(hgt, axis=0)
@@ -15,9 +15,13 @@ import numpy as np
 import logging
 import os
 import argparse
+import multiprocessing
+import time
+import traceback
 
 from datetime import datetime, timedelta
 from glob import glob
+from itertools import islice
 
 
 # Key is name of scan type in header, value is name as it should appear
@@ -31,6 +35,12 @@ lookup = {'User file 4 - stepped': 'fp',
 
 FILL_VALUE = -9999
 
+# Number of lines in the header of every hpl file
+HEADER_LINES = 17
+
+# Number of rays in each chunk of the compressed variables in compact netcdfs
+CHUNK_RAYS = 256
+
 
 def decode_header(header):
     """
@@ -50,99 +60,122 @@ def _to_epoch(dt):
     return (dt - datetime(1970, 1, 1)).total_seconds()
 
 
-def process_file(in_file, out_dir, prefix):
+def _count_lines(data):
     """
-    Processes a raw halo hpl file and turns it into a netcdf
-    :param in_file:
-    :param out_dir:
+    Counts the lines in a block of text the same way iterating over the file would
+    """
+    num_lines = data.count('\n')
+    if data and not data.endswith('\n'):
+        num_lines += 1
+
+    return num_lines
+
+
+def parse_rays(data, ngates, nrays=None):
+    """
+    Decodes the data section of a hpl file in one go. All the numbers are converted
+    in a single call to numpy and then reshaped into (nrays, ngates+1) blocks, so
+    there are no python loops over the rays or gates.
+    :param data: String containing the data lines of the file (everything after the header)
+    :param ngates: Number of gates in each ray
+    :param nrays: Number of rays to decode. Defaults to all the complete rays in data
     :return:
+    info - (nrays, 5) array of the ray info lines (hour, azimuth, elevation, pitch, roll)
+    gates - (nrays, ngates, 4) array of the gate lines (gate, velocity, intensity, beta)
     """
+    if nrays is None:
+        nrays = _count_lines(data) / (ngates + 1)
 
-    # Read in the text file
-    lines = []
-    with open(in_file) as f:
-        for line in f:
-            lines.append(line)
+    if nrays == 0:
+        return np.zeros((0, 5)), np.zeros((0, ngates, 4))
 
-    logging.debug("Decoding header")
-    # Read in the header info
-    header = decode_header(lines[0:11])
+    # Figure out how many columns the ray info and gate lines have from the first ray
+    first_lines = data.split('\n', 2)
+    info_cols = len(first_lines[0].split())
+    gate_cols = len(first_lines[1].split())
+    ray_size = info_cols + ngates * gate_cols
 
-    ngates = int(header['Number of gates'])
-    # nrays = int(header['No. of rays in file'])  # Cant do this apparently. Not always correct (wtf)
-    len_data = len(lines[17:])
-    nrays = len_data / (ngates + 1)
+    if info_cols < 5 or gate_cols < 4:
+        raise ValueError("Unexpected number of columns in data")
 
-    gate_length = float(header['Range gate length (m)'])
-    start_time = datetime.strptime(header['Start time'], '%Y%m%d %H:%M:%S.%f')
-    scan_type = lookup[header['Scan type']]
+    values = np.fromstring(data, sep=' ')
 
-    logging.info("Processing file type: %s" % scan_type)
-    logging.debug("Number of rays: %s" % nrays)
+    # Anything after the last complete ray is ignored
+    if values.size < nrays * ray_size:
+        raise ValueError("Data does not contain {} complete rays".format(nrays))
 
-    logging.debug("Reading data")
-    # Read in the actual data
-    az = np.zeros(nrays)
-    hour = np.zeros(nrays)
-    elev = np.zeros(nrays)
-    pitch = np.zeros(nrays)
-    roll = np.zeros(nrays)
-    rng = np.asarray([(gate + .5) * gate_length for gate in range(ngates)])
+    blocks = values[:nrays * ray_size].reshape((nrays, ray_size))
+
+    info = blocks[:, :5]
+    gates = blocks[:, info_cols:].reshape((nrays, ngates, gate_cols))[:, :, :4]
+
+    # If any line had a different number of columns, the gate numbers won't line up anymore
+    if np.any(gates[:, :, 0] != np.arange(ngates)):
+        raise ValueError("Gate numbers do not line up with the expected layout")
+
+    return info, gates
 
-    vel = np.zeros((ngates, nrays))
-    intensity = np.zeros((ngates, nrays))
-    beta = np.zeros((ngates, nrays))
+
+def _parse_rays_by_line(lines, ngates, nrays):
+    """
+    Slow line by line version of parse_rays. Used when a file is too mangled to
+    decode in bulk.
+    :param lines: List of the data lines of the file (everything after the header)
+    :param ngates: Number of gates in each ray
+    :param nrays: Number of rays to decode
+    :return: Same as parse_rays
+    """
+    info = np.zeros((nrays, 5))
+    gates = np.zeros((nrays, ngates, 4))
 
     try:
         for ray in range(nrays):
             # Get the scan info
-            info = lines[ray * (ngates + 1) + 17].split()
-            hour[ray] = float(info[0])
-            az[ray] = float(info[1])
-            elev[ray] = float(info[2])
-            pitch[ray] = float(info[3])
-            roll[ray] = float(info[4])
+            ray_info = lines[ray * (ngates + 1)].split()
+            info[ray] = [float(x) for x in ray_info[0:5]]
 
             for gate in range(ngates):
-                data = lines[ray * (ngates + 1) + 17 + gate + 1].split()
-                vel[gate, ray] = float(data[1])
-                intensity[gate, ray] = float(data[2])
-                beta[gate, ray] = float(data[3])
+                gate_data = lines[ray * (ngates + 1) + gate + 1].split()
+                gates[ray, gate, 1] = float(gate_data[1])
+                gates[ray, gate, 2] = float(gate_data[2])
+                gates[ray, gate, 3] = float(gate_data[3])
 
     except IndexError:
         logging.warning("Something went wrong with the indexing here...")
 
-    logging.debug('Preparing to write netcdf')
+    return info, gates
 
-    # Get the times and dates figured out for the netcdf
-    time = []
+
+def _ray_epochs(start_time, hour):
+    """
+    Converts the decimal hour of each ray into epoch time
+    :param start_time: Datetime of the start of the file
+    :param hour: Array of decimal hours from the ray info lines
+    :return: Array of epoch times
+    """
     epoch = []
     for h in hour:
         dt = datetime(start_time.year, start_time.month, start_time.day) + timedelta(hours=h)
-        time.append(dt)
         epoch.append(_to_epoch(dt))
 
-    time = np.asarray(time)
-    epoch = np.asarray(epoch)
-    base_time = _to_epoch(start_time)
-    time_offset = epoch - base_time
+    return np.asarray(epoch)
+
 
+def _setup_nc(filename, rng, start_time, compact=False):
+    """
+    Creates the netcdf for a decoded hpl file with all its variables, but no ray data. Rays
+    are added to the unlimited time dimension with _write_rays.
+    :param filename: Name of the netcdf to create
+    :param rng: Array of ranges for each gate
+    :param start_time: Datetime of the start of the file
+    :param compact: If True, the angles are stored once per ray (time,) instead of being
+                    repeated for every gate, and velocity, intensity and backscatter are
+                    stored as compressed float32
+    :return: Netcdf object
+    """
     # Figure out netcdf attrs
     nc_attrs = {'start_time': start_time.strftime('%Y-%m-%dT%H:%M:%S')}  # None right now
 
-    # Get the filename figured out
-    if prefix is None:
-        filename = start_time.strftime("{type}_%Y%m%d_%H%M%S.nc".format(type=scan_type))
-    else:
-        filename = start_time.strftime("{prefix}_{type}_%Y%m%d_%H%M%S.nc".format(type=scan_type, prefix=prefix))
-
-    if not os.path.exists(out_dir):
-        os.makedirs(out_dir)
-
-    filename = os.path.join(out_dir, filename)
-
-    # Write out the netcdf
-    logging.info("Writing netcdf")
     logging.debug("Creating file: {}".format(filename))
 
     nc = netCDF4.Dataset(filename, "w", format="NETCDF4")
@@ -159,25 +192,19 @@ def process_file(in_file, out_dir, prefix):
     var = nc.createVariable('base_time', 'i8')
     var.setncattr('long_name', 'Time')
     var.setncattr('units', 'seconds since 1970-01-01 00:00:00 UTC')
-    var[:] = base_time
+    var[:] = _to_epoch(start_time)
 
-    logging.debug('Writing time_offset')
     var = nc.createVariable('time_offset', 'i8', dimensions=('time',))
     var.setncattr('long_name', 'Time offset')
     var.setncattr('unis', 'seconds since base_time')
-    var[:] = time_offset
 
-    logging.debug('Writing epoch')
     var = nc.createVariable('epoch', 'i8', dimensions=('time',))
     var.setncattr('long_name', 'Epoch Time')
     var.setncattr('units', 'seconds since 1970-01-01 00:00:00 UTC')
-    var[:] = epoch
 
-    logging.debug('Writing hour')
     var = nc.createVariable('hour', 'f8', dimensions=('time',))
     var.setncattr('long_name', 'Hour of Day')
     var.setncattr('units', 'UTC')
-    var[:] = hour
 
     logging.debug('Writing range')
     var = nc.createVariable('range', 'f8', dimensions=('range',))
@@ -185,64 +212,417 @@ def process_file(in_file, out_dir, prefix):
     var.setncattr('units', 'km AGL')
     var[:] = rng
 
-    logging.debug('Writing azimuth')
-    var = nc.createVariable('azimuth', 'f8', dimensions=('time', 'range'))
+    if compact:
+        angle_dims = ('time',)
+        data_type = 'f4'
+        data_opts = {'zlib': True, 'shuffle': True, 'chunksizes': (CHUNK_RAYS, len(rng))}
+    else:
+        angle_dims = ('time', 'range')
+        data_type = 'f8'
+        data_opts = {}
+
+    var = nc.createVariable('azimuth', 'f8', dimensions=angle_dims)
     var.setncattr('long_name', 'Azimuth Angle')
     var.setncattr('units', 'degrees')
-    var[:] = np.tile(az, (len(rng), 1)).transpose()
 
-    logging.debug('Writing elevation')
-    var = nc.createVariable('elevation', 'f8', dimensions=('time', 'range'))
+    var = nc.createVariable('elevation', 'f8', dimensions=angle_dims)
     var.setncattr('long_name', 'Elevation angle')
     var.setncattr('units', 'degrees above the horizon')
-    var[:] = np.tile(elev, (len(rng), 1)).transpose()
 
-    logging.debug('Writing pitch')
-    var = nc.createVariable('pitch', 'f8', dimensions=('time', 'range'))
+    var = nc.createVariable('pitch', 'f8', dimensions=angle_dims)
     var.setncattr('long_name', 'Instrument Pitch')
     var.setncattr('units', 'degrees')
-    var[:] = np.tile(pitch, (len(rng), 1)).transpose()
 
-    logging.debug('Writing roll')
-    var = nc.createVariable('roll', 'f8', dimensions=('time', 'range'))
+    var = nc.createVariable('roll', 'f8', dimensions=angle_dims)
     var.setncattr('long_name', 'Instrument Roll')
     var.setncattr('units', 'degrees')
-    var[:] = np.tile(roll, (len(rng), 1)).transpose()
 
-    logging.debug('Writing velocity')
-    var = nc.createVariable('velocity', 'f8', dimensions=('time', 'range'))
+    var = nc.createVariable('velocity', data_type, dimensions=('time', 'range'), **data_opts)
     var.setncattr('long_name', 'Doppler velocity')
     var.setncattr('units', 'm/s')
     var.setncattr('comment', 'Positive values are toward the radar')
-    var[:] = vel.transpose()
 
-    logging.debug('Writing intensity')
-    var = nc.createVariable('intensity', 'f8', dimensions=('time', 'range'))
+    var = nc.createVariable('intensity', data_type, dimensions=('time', 'range'), **data_opts)
     var.setncattr('long_name', 'Intensity')
     var.setncattr('units', 'Unitless')
     var.setncattr('comment', 'This is computed as (SNR+1)')
-    var[:] = intensity.transpose()
 
-    logging.debug('Writing backscatter')
-    var = nc.createVariable('backscatter', 'f8', dimensions=('time', 'range'))
+    var = nc.createVariable('backscatter', data_type, dimensions=('time', 'range'), **data_opts)
     var.setncattr('long_name', 'Attenuated backscatter')
     var.setncattr('units', 'km^(-1) sr^(-1)')
-    var[:] = (beta*1e3).transpose()
+
+    return nc
+
+
+def _write_rays(nc, info, gates, start_time):
+    """
+    Appends a batch of decoded rays to the end of the time dimension of a netcdf
+    made by _setup_nc
+    :param nc: Netcdf object to write to
+    :param info: (nrays, 5) array of ray info from parse_rays
+    :param gates: (nrays, ngates, 4) array of gate data from parse_rays
+    :param start_time: Datetime of the start of the file
+    :return: Number of rays written
+    """
+    nrays = info.shape[0]
+    if nrays == 0:
+        return 0
+
+    ngates = gates.shape[1]
+
+    # Get the times and dates figured out for the netcdf
+    epoch = _ray_epochs(start_time, info[:, 0])
+    time_offset = epoch - _to_epoch(start_time)
+
+    # Where this batch goes in the file
+    start = len(nc.dimensions['time'])
+    end = start + nrays
+
+    nc['time_offset'][start:end] = time_offset
+    nc['epoch'][start:end] = epoch
+    nc['hour'][start:end] = info[:, 0]
+
+    # Compact files only have one angle per ray
+    for i, var in enumerate(['azimuth', 'elevation', 'pitch', 'roll']):
+        if nc[var].ndim == 1:
+            nc[var][start:end] = info[:, i + 1]
+        else:
+            nc[var][start:end] = np.tile(info[:, i + 1], (ngates, 1)).transpose()
+
+    nc['velocity'][start:end] = gates[:, :, 1]
+    nc['intensity'][start:end] = gates[:, :, 2]
+    nc['backscatter'][start:end] = gates[:, :, 3] * 1e3
+
+    return nrays
+
+
+def _decode_rays(data, ngates):
+    """
+    Decodes all the complete rays in a chunk of the data section, falling back to
+    the line by line decoder if the chunk can't be done in bulk
+    """
+    nrays = _count_lines(data) / (ngates + 1)
+
+    try:
+        return parse_rays(data, ngates, nrays)
+    except ValueError:
+        # Something in the file doesn't line up with the expected layout, so fall
+        # back to going through it line by line
+        logging.warning("Could not bulk decode file, falling back to line by line decoding")
+        return _parse_rays_by_line(data.splitlines(True), ngates, nrays)
+
+
+def _file_info(lines, out_dir, prefix):
+    """
+    Pulls what is needed to decode the file out of the header and figures out the
+    name of the netcdf to write to
+    :param lines: The 17 header lines of the hpl file
+    :param out_dir: Directory the netcdf will be written to
+    :param prefix: Prefix for the netcdf filename
+    :return:
+    ngates - Number of gates per ray
+    rng - Array of ranges for each gate
+    start_time - Datetime of the start of the file
+    filename - Full path to the netcdf
+    """
+    logging.debug("Decoding header")
+    # Read in the header info
+    header = decode_header(lines[0:11])
+
+    ngates = int(header['Number of gates'])
+    # nrays = int(header['No. of rays in file'])  # Cant do this apparently. Not always correct (wtf)
+
+    gate_length = float(header['Range gate length (m)'])
+    start_time = datetime.strptime(header['Start time'], '%Y%m%d %H:%M:%S.%f')
+    scan_type = lookup[header['Scan type']]
+
+    logging.info("Processing file type: %s" % scan_type)
+
+    rng = np.asarray([(gate + .5) * gate_length for gate in range(ngates)])
+
+    # Get the filename figured out
+    if prefix is None:
+        filename = start_time.strftime("{type}_%Y%m%d_%H%M%S.nc".format(type=scan_type))
+    else:
+        filename = start_time.strftime("{prefix}_{type}_%Y%m%d_%H%M%S.nc".format(type=scan_type, prefix=prefix))
+
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    filename = os.path.join(out_dir, filename)
+
+    return ngates, rng, start_time, filename
+
+
+def process_file(in_file, out_dir, prefix, batch_size=None, compact=False):
+    """
+    Processes a raw halo hpl file and turns it into a netcdf
+    :param in_file:
+    :param out_dir:
+    :param prefix:
+    :param batch_size: Number of rays to decode at a time. If None, the whole file is read
+                       at once. Otherwise, only batch_size rays are held in memory and each
+                       batch is appended to the netcdf as it is decoded.
+    :param compact: Write the smaller netcdf layout (see _setup_nc)
+    :return:
+    """
+
+    with open(in_file) as f:
+        # Read in the header. It is always 17 lines, everything after that is data
+        lines = [f.readline() for i in range(HEADER_LINES)]
+        ngates, rng, start_time, filename = _file_info(lines, out_dir, prefix)
+
+        # Write out the netcdf. It gets a temporary name until it's finished so an
+        # interrupted run doesn't leave behind something that looks complete
+        logging.info("Writing netcdf")
+        tmp_filename = filename + '.tmp'
+        nc = _setup_nc(tmp_filename, rng, start_time, compact=compact)
+
+        logging.debug("Reading data")
+        nrays = 0
+        if batch_size is None:
+            info, gates = _decode_rays(f.read(), ngates)
+            nrays += _write_rays(nc, info, gates, start_time)
+        else:
+            # Each ray is ngates+1 lines, so read in whole rays at a time
+            while True:
+                data = "".join(islice(f, batch_size * (ngates + 1)))
+                if not data:
+                    break
+
+                info, gates = _decode_rays(data, ngates)
+                nrays += _write_rays(nc, info, gates, start_time)
+                logging.debug("Wrote {} rays".format(nrays))
+
+    logging.debug("Number of rays: %s" % nrays)
 
     logging.debug('Closing file')
     nc.close()
+    os.rename(tmp_filename, filename)
 
     logging.info("Netcdf successfully created!")
 
     return filename
 
 
+def _complete_rays(data, ngates):
+    """
+    Finds the complete rays at the start of a chunk of a file that is still being written
+    :param data: String read from the file, starting at the beginning of a ray
+    :param ngates: Number of gates per ray
+    :return: The part of data that contains only complete rays
+    """
+    # Find the end of every full line. Anything after the last newline is still being written
+    newlines = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == ord('\n'))
+
+    nrays = newlines.size / (ngates + 1)
+    if nrays == 0:
+        return ''
+
+    return data[:newlines[nrays * (ngates + 1) - 1] + 1]
+
+
+def follow_file(in_file, out_dir, prefix, poll_time=10, idle_time=600, compact=False):
+    """
+    Decodes a hpl file while the lidar is still writing it. Complete rays are appended
+    to the netcdf as they show up. The byte offset of the next undecoded ray is kept in
+    the netcdf's 'hpl_offset' attribute, so following the same file again picks up
+    where it left off instead of decoding the whole thing again.
+    :param in_file: hpl file to follow
+    :param out_dir: Directory to write the netcdf to
+    :param prefix: Prefix for the netcdf filename
+    :param poll_time: Seconds to wait between checking the file for new rays
+    :param idle_time: Stop following once the file hasn't grown in this many seconds
+    :param compact: Write the smaller netcdf layout (see _setup_nc). Only used when the
+                    netcdf is created, resuming keeps whatever layout the file has.
+    :return: Name of the netcdf
+    """
+    # Wait for the whole header to get written. The file is read in binary mode so the
+    # offsets are real byte offsets, even where text mode would translate line endings.
+    last_change = time.time()
+    while True:
+        with open(in_file, 'rb') as f:
+            lines = [f.readline() for i in range(HEADER_LINES)]
+
+        if all(line.endswith('\n') for line in lines):
+            break
+        elif time.time() - last_change > idle_time:
+            logging.warning("Header of {} was never finished".format(in_file))
+            return None
+
+        time.sleep(poll_time)
+
+    ngates, rng, start_time, filename = _file_info(lines, out_dir, prefix)
+
+    # Pick up where we left off if this file has been followed before
+    nc = None
+    if os.path.exists(filename):
+        nc = netCDF4.Dataset(filename, 'a')
+        if 'hpl_offset' in nc.ncattrs():
+            offset = int(nc.getncattr('hpl_offset'))
+            logging.info("Resuming {} at byte {}".format(in_file, offset))
+        else:
+            # Netcdf was made some other way, so start over
+            nc.close()
+            nc = None
+
+    if nc is None:
+        logging.info("Creating netcdf {}".format(filename))
+        nc = _setup_nc(filename, rng, start_time, compact=compact)
+        offset = sum(len(line) for line in lines)
+        nc.setncattr('hpl_offset', offset)
+
+    nrays = len(nc.dimensions['time'])
+    last_change = time.time()
+
+    try:
+        while True:
+            with open(in_file, 'rb') as f:
+                f.seek(offset)
+                data = _complete_rays(f.read(), ngates)
+
+            if data:
+                info, gates = _decode_rays(data, ngates)
+                nrays += _write_rays(nc, info, gates, start_time)
+
+                offset += len(data)
+                nc.setncattr('hpl_offset', offset)
+                nc.sync()
+
+                logging.debug("Wrote {} rays".format(nrays))
+                last_change = time.time()
+            elif time.time() - last_change > idle_time:
+                logging.info("No new rays in {} seconds, done following {}".format(idle_time, in_file))
+                break
+
+            time.sleep(poll_time)
+
+    finally:
+        nc.close()
+
+    return filename
+
+
+def _out_filename(in_file, out_dir, prefix):
+    """
+    Gets the name of the netcdf a hpl file is decoded to
+    """
+    with open(in_file) as f:
+        lines = [f.readline() for i in range(HEADER_LINES)]
+
+    return _file_info(lines, out_dir, prefix)[-1]
+
+
+def _is_current(in_file, out_dir, prefix, filename=None):
+    """
+    Checks if the netcdf for a hpl file already exists and is newer than the hpl file
+    """
+    if filename is None:
+        filename = _out_filename(in_file, out_dir, prefix)
+
+    return os.path.exists(filename) and os.path.getmtime(filename) >= os.path.getmtime(in_file)
+
+
+def _decode_worker(job):
+    """
+    Decodes a single file for decode_files. Errors are caught and sent back
+    so one bad file doesn't stop the rest.
+    :return: (in_file, filename, seconds taken, traceback or None)
+    """
+    in_file, out_dir, prefix, batch_size, compact = job
+
+    start = time.time()
+    try:
+        filename = process_file(in_file, out_dir, prefix, batch_size=batch_size, compact=compact)
+        return in_file, filename, time.time() - start, None
+    except Exception:
+        return in_file, None, time.time() - start, traceback.format_exc()
+
+
+def decode_files(in_files, out_dir, prefix, batch_size=None, jobs=1, force=False, compact=False):
+    """
+    Decodes a bunch of hpl files, optionally in parallel. Files that already have a
+    netcdf newer than the hpl file are skipped, so rerunning an interrupted job
+    picks up where it left off.
+    :param in_files: List of hpl files
+    :param out_dir: Directory to write the netcdfs to
+    :param prefix: Prefix for the netcdf filenames
+    :param batch_size: Passed on to process_file
+    :param jobs: Number of processes to use
+    :param force: Decode every file, even if its netcdf is up to date
+    :param compact: Passed on to process_file
+    :return: List of (in_file, filename, seconds taken, traceback or None) for each decoded file
+    """
+    todo = []
+    done = []
+    out_files = {}
+    for f in in_files:
+        try:
+            filename = _out_filename(f, out_dir, prefix)
+        except Exception:
+            # Let the worker deal with (and report) files with a bad header
+            todo.append((f, out_dir, prefix, batch_size, compact))
+            continue
+
+        # Two files with the same start time and scan type would write (and in parallel,
+        # clobber) the same netcdf, so only the first one gets decoded
+        if filename in out_files:
+            error = 'Duplicate output: {} would also be written to {}'.format(out_files[filename], filename)
+            logging.error('Skipping {}. {}'.format(f, error))
+            done.append((f, None, 0., error))
+            continue
+        out_files[filename] = f
+
+        if not force and _is_current(f, out_dir, prefix, filename=filename):
+            logging.info('Skipping {}, netcdf is up to date'.format(f))
+            continue
+
+        todo.append((f, out_dir, prefix, batch_size, compact))
+
+    logging.info('Decoding {} of {} files'.format(len(todo), len(in_files)))
+
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        results = pool.imap_unordered(_decode_worker, todo)
+    else:
+        pool = None
+        results = (_decode_worker(job) for job in todo)
+
+    for in_file, filename, elapsed, error in results:
+        if error is None:
+            logging.info('Decoded {} to {} in {:.1f} s'.format(in_file, filename, elapsed))
+        else:
+            logging.error('Failed to decode {} after {:.1f} s\n{}'.format(in_file, elapsed, error))
+
+        done.append((in_file, filename, elapsed, error))
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    return done
+
+
 if __name__=='__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-i', dest='in_files', nargs='*')
     parser.add_argument('-o', dest='out_dir')
     parser.add_argument('-v', '--verbose', dest='verbose', action='store_true')
     parser.add_argument('-p', '--prefix', dest='prefix', default=None)
+    parser.add_argument('-b', '--batch-size', dest='batch_size', type=int, default=None,
+                        help='Decode this many rays at a time to keep memory use down on large files')
+    parser.add_argument('-f', '--follow', dest='follow', action='store_true',
+                        help='Keep decoding the files as the lidar writes to them')
+    parser.add_argument('--poll', dest='poll_time', type=float, default=10,
+                        help='Seconds between checks for new rays when following')
+    parser.add_argument('--idle', dest='idle_time', type=float, default=600,
+                        help='Stop following a file after it has not changed in this many seconds')
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=1,
+                        help='Number of files to decode in parallel')
+    parser.add_argument('--force', dest='force', action='store_true',
+                        help='Decode files even if their netcdf is newer than the hpl file')
+    parser.add_argument('-c', '--compact', dest='compact', action='store_true',
+                        help='Store angles once per ray and the data as compressed float32')
     args = parser.parse_args()
 
     if args.verbose:
@@ -250,9 +630,11 @@ if __name__=='__main__':
     else:
         logging.basicConfig(format='%(asctime)s:%(levelname)s:%(message)s', level=logging.INFO)
 
-    for f in args.in_files:
-        logging.info('Processing file %s' % f)
-        filename = process_file(f, args.out_dir, args.prefix)
-
-
-
+    if args.follow:
+        for f in args.in_files:
+            logging.info('Processing file %s' % f)
+            filename = follow_file(f, args.out_dir, args.prefix, poll_time=args.poll_time, idle_time=args.idle_time,
+                                   compact=args.compact)
+    else:
+        decode_files(args.in_files, args.out_dir, args.prefix, batch_size=args.batch_size,
+                     jobs=args.jobs, force=args.force, compact=args.compact)
@@ -0,0 +1,215 @@
+"""
+Random access reader for raw .hpl files from the Halo Photonics doppler lidar. Builds
+an index of the byte offset of every ray so individual rays or time windows can be
+pulled out of a file without decoding the whole thing. The index is cached next to
+the hpl file so opening the same file again doesn't need to scan it.
+
+Usage:
+    with HplReader('Stare_46_20170601_00.hpl') as hpl:
+        info, gates = hpl[100:200]
+        info, gates = hpl.time_slice(datetime(2017, 6, 1, 0, 30), datetime(2017, 6, 1, 0, 45))
+"""
+
+import logging
+import mmap
+import os
+
+from datetime import datetime
+
+import numpy as np
+
+from halo_dl_decode import HEADER_LINES, decode_header, parse_rays, _ray_epochs, _to_epoch
+
+# Size of the blocks used when scanning the file for newlines
+SCAN_BLOCK_SIZE = 64 * 1024 * 1024
+
+
+def _newline_offsets(buf, start):
+    """
+    Finds the byte offset of every newline in buf after start. Goes through the file a
+    block at a time so scanning a big file doesn't need a huge temporary array.
+    """
+    offsets = []
+    for block_start in range(start, len(buf), SCAN_BLOCK_SIZE):
+        block = np.frombuffer(buf[block_start:block_start + SCAN_BLOCK_SIZE], dtype=np.uint8)
+        offsets.append(np.flatnonzero(block == ord('\n')) + block_start)
+
+    if len(offsets) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    return np.concatenate(offsets).astype(np.int64)
+
+
+class HplReader(object):
+    """
+    Memory maps a hpl file and decodes only the rays that are asked for. Indexing
+    with an int or slice returns (info, gates) arrays in the same layout as
+    halo_dl_decode.parse_rays.
+    """
+
+    def __init__(self, in_file, cache=True):
+        """
+        :param in_file: hpl file to read
+        :param cache: Whether to use/write the cached index next to the file
+        """
+        self.in_file = in_file
+        self._f = open(in_file, 'rb')
+        self._buf = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._mtime = os.fstat(self._f.fileno()).st_mtime
+
+        # The header is always the first 17 lines
+        lines = []
+        pos = 0
+        for i in range(HEADER_LINES):
+            end = self._buf.find('\n', pos) + 1
+            lines.append(self._buf[pos:end])
+            pos = end
+
+        self.header = decode_header(lines[0:11])
+        self.ngates = int(self.header['Number of gates'])
+        self.start_time = datetime.strptime(self.header['Start time'], '%Y%m%d %H:%M:%S.%f')
+
+        gate_length = float(self.header['Range gate length (m)'])
+        self.range = np.asarray([(gate + .5) * gate_length for gate in range(self.ngates)])
+
+        self._data_start = pos
+
+        self.offsets = None
+        self.hour = None
+
+        if cache:
+            self._load_index()
+
+        if self.offsets is None:
+            self._build_index()
+
+            if cache:
+                self._save_index()
+
+        self.epoch = _ray_epochs(self.start_time, self.hour)
+
+    @property
+    def index_file(self):
+        return self.in_file + '.idx.npz'
+
+    def _build_index(self):
+        """
+        Finds the byte offset of the start of every complete ray and reads the
+        decimal hour of each one
+        """
+        logging.debug("Building ray index for {}".format(self.in_file))
+
+        newlines = _newline_offsets(self._buf, self._data_start)
+
+        # Each ray is ngates+1 lines. offsets[i] is the start of ray i and offsets[-1]
+        # is the end of the last complete ray
+        nrays = newlines.size / (self.ngates + 1)
+        ends = newlines[self.ngates::self.ngates + 1][:nrays] + 1
+
+        self.offsets = np.concatenate(([self._data_start], ends)).astype(np.int64)
+
+        # Files that were just created might not have any rays yet
+        if nrays == 0:
+            self.hour = np.zeros(0)
+            return
+
+        # Only decode the ray info lines to get the times
+        info_ends = newlines[::self.ngates + 1][:nrays] + 1
+        info_lines = "".join(self._buf[start:end] for start, end in zip(self.offsets[:-1], info_ends))
+
+        self.hour = np.fromstring(info_lines, sep=' ').reshape((nrays, -1))[:, 0]
+
+    def _load_index(self):
+        """
+        Loads the cached index if it was made for this version of the file
+        """
+        if not os.path.exists(self.index_file):
+            return
+
+        try:
+            with np.load(self.index_file) as index:
+                if ('mtime' not in index.files or index['mtime'] != self._mtime or
+                        index['size'] != len(self._buf) or index['ngates'] != self.ngates):
+                    logging.debug("Cached index for {} is out of date".format(self.in_file))
+                    return
+
+                self.offsets = index['offsets']
+                self.hour = index['hour']
+        except (IOError, KeyError, ValueError):
+            logging.warning("Could not read cached index {}".format(self.index_file))
+
+    def _save_index(self):
+        try:
+            with open(self.index_file, 'wb') as f:
+                np.savez(f, offsets=self.offsets, hour=self.hour, size=len(self._buf), ngates=self.ngates,
+                         mtime=self._mtime)
+        except IOError:
+            logging.warning("Could not write cached index {}".format(self.index_file))
+
+    def __len__(self):
+        return self.offsets.size - 1
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            start, stop, step = item.indices(len(self))
+            if step != 1:
+                return self.read_rays(range(start, stop, step))
+
+            return self._read_block(start, stop)
+
+        if isinstance(item, (int, long, np.integer)):
+            if item < 0:
+                item += len(self)
+            if item < 0 or item >= len(self):
+                raise IndexError("Ray index out of range")
+
+            return self._read_block(item, item + 1)
+
+        return self.read_rays(item)
+
+    def _read_block(self, start, stop):
+        """
+        Decodes the contiguous rays start through stop-1
+        """
+        if stop <= start:
+            return parse_rays('', self.ngates, 0)
+
+        return parse_rays(self._buf[self.offsets[start]:self.offsets[stop]], self.ngates, stop - start)
+
+    def read_rays(self, rays):
+        """
+        Decodes an arbitrary list of rays
+        :param rays: Sequence of ray indices
+        :return: info, gates arrays
+        """
+        rays = np.arange(len(self))[np.asarray(rays)]
+        data = "".join(self._buf[self.offsets[ray]:self.offsets[ray + 1]] for ray in rays)
+
+        return parse_rays(data, self.ngates, rays.size)
+
+    def time_slice(self, start, end):
+        """
+        Decodes the rays with start <= time < end. Rays are assumed to be in time order.
+        :param start: Start datetime
+        :param end: End datetime
+        :return: info, gates arrays
+        """
+        ind = self.time_index(start, end)
+        return self._read_block(ind.start, ind.stop)
+
+    def time_index(self, start, end):
+        """
+        Returns the slice of ray indices with start <= time < end
+        """
+        return slice(np.searchsorted(self.epoch, _to_epoch(start), side='left'),
+                     np.searchsorted(self.epoch, _to_epoch(end), side='left'))
+
+    def close(self):
+        self._buf.close()
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
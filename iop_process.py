@@ -1,19 +1,168 @@
+"""
+Extracts the VAD data for each mission in the IOP priority list. By default all the
+missions are done in one pass over the VAD files. With -j the missions are split between
+worker processes instead. Each mission's file is written under a temporary name and only
+renamed once it's complete.
+
+Usage:
+    python iop_process.py -d /data/pecan_mp1_lidar_vad -f 'Copy of IOPPriorityList.csv' -j 4
+"""
+
+import argparse
 import csv
+import logging
+import multiprocessing
 import os
-from lidar_to_iop import process_files
+import time
+import traceback
+
 from datetime import datetime
 
+import nc_catalog
+from lidar_to_iop import FILE_PATTERN, process_files, process_iops
+
 input_dir = '/Users/tylerbell/data/pecan_mp1_lidar_vad/'
+iop_list = '/Users/tylerbell/data/Copy of IOPPriorityList.csv'
+
+
+def read_iops(csv_file, out_dir, prefix='pecan_mp1_lidar_vad'):
+    """
+    Reads the missions from the IOP priority list
+    :param csv_file: IOP priority list
+    :param out_dir: Directory for the mission files
+    :param prefix: Prefix for the mission files
+    :return: List of (mission, start, end, out_file) tuples
+    """
+    iops = []
+    with open(csv_file) as csvfile:
+        reader = csv.DictReader(csvfile, delimiter=',')
+
+        for row in reader:
+            try:
+                start = datetime.strptime(row['Start Date'] + row['Start Time'], "%m/%d/%y%H:%M UTC")
+                end = datetime.strptime(row['End Date'] + row['End Time'], "%m/%d/%y%H:%M UTC")
+                new_file = '{}_{}.nc'.format(prefix, row['Mission'])
+                iops.append((row['Mission'], start, end, os.path.join(out_dir, new_file)))
+            except Exception:
+                logging.error("Could not read the times for mission {} ({})\n{}".format(
+                    row.get('Mission'), row.get('Start Date'), traceback.format_exc()))
+
+    return iops
+
+
+def _tmp_file(out_file):
+    # Doesn't match the date pattern, so it's never taken as an input file
+    return out_file + '.tmp'
+
+
+def _remove(filename):
+    if os.path.exists(filename):
+        os.remove(filename)
+
 
-with open('/Users/tylerbell/data/Copy of IOPPriorityList.csv') as csvfile:
-    reader = csv.DictReader(csvfile, delimiter=',')
+def _process_mission(job):
+    """
+    Extracts one mission in a worker process
+    :param job: (mission, start, end, out_file, dir, catalog_file) tuple
+    :return: mission, time taken, traceback (None if it worked)
+    """
+    mission, start, end, out_file, dir, catalog_file = job
+    start_time = time.time()
+    tmp_file = _tmp_file(out_file)
 
-    for row in reader:
+    try:
+        catalog = nc_catalog.Catalog(catalog_file) if catalog_file is not None else None
         try:
+            process_files(start, end, dir, tmp_file, catalog=catalog, update=False)
+        finally:
+            if catalog is not None:
+                catalog.close()
+
+        os.rename(tmp_file, out_file)
+        return mission, time.time() - start_time, None
+    except Exception:
+        _remove(tmp_file)
+        return mission, time.time() - start_time, traceback.format_exc()
+
+
+def process_missions(iops, dir, jobs=1, catalog_file=None):
+    """
+    Extracts all the missions
+    :param iops: List of (mission, start, end, out_file) tuples
+    :param dir: Directory containing the VAD files
+    :param jobs: Number of worker processes. With 1 all the missions are done in one pass
+                 over the files.
+    :param catalog_file: nc_catalog file to find the VAD files with. None finds them by the
+                         dates in their names.
+    :return: List of the missions that failed
+    """
+    # Bring the catalog up to date once here so the extraction only has to read it
+    if catalog_file is not None:
+        catalog = nc_catalog.Catalog(catalog_file)
+        catalog.update(dir, pattern=FILE_PATTERN)
+        catalog.close()
+
+    failed = []
+    start_time = time.time()
+
+    if jobs == 1:
+        catalog = nc_catalog.Catalog(catalog_file) if catalog_file is not None else None
+        errors = process_iops([(mission, start, end, _tmp_file(out_file)) for mission, start, end, out_file in iops],
+                              dir, catalog=catalog, update=False)
+        if catalog is not None:
+            catalog.close()
+
+        for mission, start, end, out_file in iops:
+            if mission in errors:
+                _remove(_tmp_file(out_file))
+                logging.error("Mission {} failed\n{}".format(
+                    mission, ''.join(traceback.format_exception(*errors[mission]))))
+                failed.append(mission)
+            else:
+                os.rename(_tmp_file(out_file), out_file)
+                logging.info("Mission {} -> {}".format(mission, out_file))
+    else:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            mission_jobs = [iop + (dir, catalog_file) for iop in iops]
+            for mission, elapsed, tb in pool.imap_unordered(_process_mission, mission_jobs):
+                if tb is None:
+                    logging.info("Mission {} done in {:.1f} s".format(mission, elapsed))
+                else:
+                    logging.error("Mission {} failed after {:.1f} s\n{}".format(mission, elapsed, tb))
+                    failed.append(mission)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    logging.info("{} of {} missions done in {:.1f} s".format(len(iops) - len(failed), len(iops),
+                                                               time.time() - start_time))
+
+    return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', dest='dir', default=input_dir, help='Directory containing the VAD files')
+    parser.add_argument('-f', dest='iop_list', default=iop_list, help='IOP priority list (csv)')
+    parser.add_argument('-o', dest='out_dir', default=None,
+                        help='Directory for the mission files (default: the VAD directory)')
+    parser.add_argument('-O', dest='out_prefix', default='pecan_mp1_lidar_vad')
+    parser.add_argument('-j', dest='jobs', type=int, default=1,
+                        help='Number of missions to extract at once (0 for one per CPU)')
+    parser.add_argument('--catalog', dest='catalog', default=None,
+                        help='Catalog of the VAD files (default: {} in the VAD directory)'.format(
+                            nc_catalog.CATALOG_NAME))
+    parser.add_argument('--no-catalog', dest='use_catalog', action='store_false',
+                        help='Find the VAD files by the dates in their names instead of using a catalog')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s:%(levelname)s:%(message)s', level=logging.INFO)
+
+    catalog_file = None
+    if args.use_catalog:
+        catalog_file = args.catalog or os.path.join(args.dir, nc_catalog.CATALOG_NAME)
 
-            start = datetime.strptime(row['Start Date'] + row['Start Time'], "%m/%d/%y%H:%M UTC")
-            end = datetime.strptime(row['End Date'] + row['End Time'], "%m/%d/%y%H:%M UTC")
-            new_file = 'pecan_mp1_lidar_vad_{}.nc'.format(row['Mission'])
-            process_files(start, end, input_dir, os.path.join(input_dir, new_file))
-        except Exception:
-            print row['Start Date']
\ No newline at end of file
+    iops = read_iops(args.iop_list, args.out_dir or args.dir, prefix=args.out_prefix)
+    process_missions(iops, args.dir, jobs=args.jobs or multiprocessing.cpu_count(), catalog_file=catalog_file)
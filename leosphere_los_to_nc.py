@@ -8,38 +8,174 @@ Author: Tyler Bell (Oct 2016)
 
 import argparse
 import csv
+import multiprocessing
 import os
+import shutil
 import StringIO
+import tempfile
+import traceback
 
+from collections import deque
 from datetime import datetime
+from itertools import islice
 
 import netCDF4
 import numpy as np
 
 MISSING_DATA_VALUE = -9999.
+CHUNK_ROWS = 256  # Number of lines in each chunk of the netcdf when converting a block at a time
+SPLIT_SIZE = 32 * 1024 * 1024  # Bytes of the file each worker parses at a time when converting in parallel
+SHARED_DIR = '/dev/shm'  # Workers hand their arrays back through memory mapped files here (if it exists)
 
+# Column layout of the data lines. The columns are hard coded to match specified products.
+AZ_COL = 6
+ELEV_COL = 7
+GATE_COL = 8  # First column of the first gate. Radial wind, dispersion and cnr are the first 3 of each gate
+GATE_WIDTH = 8  # Number of columns for each gate
 
-def _to_epoch(dt):
-    return (dt - datetime(1970, 1, 1)).total_seconds()
+
+def _used_columns(col, num_ranges):
+    """
+    Picks the columns that get used (azimuth, elevation, and the radial wind, dispersion
+    and cnr of each gate) out of a split data line. Returns None if the line doesn't have
+    the right number of columns.
+    """
+    if not GATE_COL + GATE_WIDTH * (num_ranges - 1) + 3 <= len(col) <= GATE_COL + GATE_WIDTH * num_ranges:
+        return None
+
+    return col[AZ_COL:ELEV_COL + 1] + col[GATE_COL::GATE_WIDTH] + col[GATE_COL + 1::GATE_WIDTH] + \
+        col[GATE_COL + 2::GATE_WIDTH]
 
 
-def process_file(in_file, out_dir, out_prefix):
+def _to_epochs(timestamps):
     """
+    Converts the timestamps to epoch seconds in one go with datetime64. Fractional seconds
+    are dropped.
+    :return: Array of epoch times (0 for the timestamps that can't be read) and a boolean
+             array marking the ones that couldn't
+    """
+    timestamps = np.char.replace(np.char.replace(np.asarray(timestamps), '/', '-'), '  ', 'T')
 
-    :param in_file:
-    :param out_dir:
-    :param out_prefix:
-    :return:
+    try:
+        times = timestamps.astype('datetime64[us]')
+    except ValueError:
+        times = np.empty(timestamps.size, dtype='datetime64[us]')
+        for i, ts in enumerate(timestamps):
+            try:
+                times[i] = np.datetime64(ts, 'us')
+            except ValueError:
+                times[i] = np.datetime64('NaT')
+
+    # NaT is the smallest int64 (np.isnat needs numpy 1.13)
+    bad = times.astype(np.int64) == np.iinfo(np.int64).min
+    epochs = times.astype('datetime64[s]').astype(np.int64)
+
+    return np.where(bad, 0, epochs), bad
+
+
+def _parse_bad_line(col, num_ranges):
+    """
+    Parses a line that couldn't be done in bulk one field at a time, the way the old parser
+    did. Everything up to the first value that can't be read is kept, and the rest is 0.
+    A bad timestamp means none of the line is kept.
+    :param col: Split data line
+    :param num_ranges: Number of range gates
+    :return: (2 + 3*nranges,) array of the azimuth, elevation, radial wind, dispersion and cnr
     """
+    row = np.zeros((5, num_ranges))
 
-    # Read in the data
-    data = []
-    with open(in_file) as f:
-        for line in f:
-            data.append(line.replace('NaN', str(MISSING_DATA_VALUE)))
+    try:
+        datetime.strptime(col[0], '%Y/%m/%d  %H:%M:%S.%f')
+        row[0, :] = col[AZ_COL]
+        row[1, :] = col[ELEV_COL]
+        row[2, :] = col[GATE_COL::GATE_WIDTH]
+        row[3, :] = col[GATE_COL + 1::GATE_WIDTH]
+        row[4, :] = col[GATE_COL + 2::GATE_WIDTH]
+    except (ValueError, IndexError):
+        pass
+
+    return np.concatenate((row[0, :1], row[1, :1], row[2:].ravel()))
+
+
+def parse_lines(lines, num_ranges, in_file=None, first_line=0):
+    """
+    Parses a list of data lines from a los file. The columns that are needed are picked
+    out of each line, and then all of them are converted to numbers at once into a
+    (nlines, 2 + 3*nranges) array, which the variables are sliced out of. Lines with
+    something that isn't a number in them are redone with _parse_bad_line.
+    :param lines: List of data lines
+    :param num_ranges: Number of range gates
+    :param in_file: Name of the file (only used for the error messages)
+    :param first_line: Line number of the first line (only used for the error messages)
+    :return: Dictionary of the time, azimuth, elevation, radial_wind, dispersion and cnr arrays
+    """
+    num_values = 2 + 3 * num_ranges
+
+    timestamps = []
+    values = []
+    bad = set()
+    for i, line in enumerate(lines):
+        col = line.split('\t')
+        timestamps.append(col[0])
+
+        used = _used_columns(col, num_ranges)
+        if used is None:
+            bad.add(i)
+            used = ['0'] * num_values
+
+        # Joined back up per line so there aren't millions of little strings around at once
+        values.append(' '.join(used))
+
+    time, bad_time = _to_epochs(timestamps)
+    bad.update(np.flatnonzero(bad_time))
+
+    # NaNs come through as NaN
+    data = np.fromstring(' '.join(values), sep=' ')
+
+    if data.size != len(lines) * num_values:
+        # Something in there isn't a number, so go line by line to find it
+        data = np.zeros((len(lines), num_values))
+        for i in xrange(len(lines)):
+            row = np.fromstring(values[i], sep=' ')
+            if row.size == num_values:
+                data[i] = row
+            else:
+                bad.add(i)
+    else:
+        data = data.reshape((len(lines), num_values))
+
+    for i in sorted(bad):
+        print "Value error in line {} for file {}".format(first_line + i, in_file)
+        data[i] = _parse_bad_line(lines[i].split('\t'), num_ranges)
+
+    data[np.isnan(data)] = MISSING_DATA_VALUE
+
+    angles = np.ones((1, num_ranges))
+    gates = data[:, 2:].reshape((len(lines), 3, num_ranges))
+
+    return {'time': time,
+            'azimuth': data[:, 0, np.newaxis] * angles,
+            'elevation': data[:, 1, np.newaxis] * angles,
+            'radial_wind': gates[:, 0],
+            'dispersion': gates[:, 1],
+            'cnr': gates[:, 2]}
+
+
+def _read_header(f):
+    """
+    Reads the header (and the column names line after it) from an open los file
+    :param f: File object at the start of the file
+    :return:
+    attrs - Dictionary of netcdf attributes
+    range - Array of the range gates
+    """
+    data = [f.readline()]
 
     # Get the number of lines in the header (hopefully in the first line of the file)
     header_size = int(data[0].split('=')[-1])
+    data += [f.readline() for i in xrange(header_size)]
+
+    data = [line.replace('NaN', str(MISSING_DATA_VALUE)) for line in data]
 
     # Dictionary for netcdf attributes
     attrs = {}
@@ -62,48 +198,22 @@ def process_file(in_file, out_dir, out_prefix):
     # Go ahead and grab the full header just in case there's something useful in it
     attrs['full_header'] = "".join(data[0:header_size])
 
-    # Initialize the data arrays
-    num_times = len(data[header_size+1:])
-    num_ranges = len(range)
-
-    time = np.zeros((num_times,), dtype=np.int64)
-    azimuth = np.zeros((num_times, num_ranges), dtype=np.float64)
-    elevation = np.zeros((num_times, num_ranges), dtype=np.float64)
-    cnr = np.zeros((num_times, num_ranges), dtype=np.float64)
-    radial_wind = np.zeros((num_times, num_ranges), dtype=np.float64)
-    dispersion = np.zeros((num_times,num_ranges), dtype=np.float64)
-
-    # Fill the arrays
-    for i, line in enumerate(data[header_size+1:]):
-        # Split the line into columns
-        col = line.split('\t')
+    return attrs, range
 
-        try:
-            # The columns are hard coded to match specified products
-            time[i] = _to_epoch(datetime.strptime(col[0], '%Y/%m/%d  %H:%M:%S.%f'))
-            azimuth[i, :] = col[6]
-            elevation[i, :] = col[7]
-            radial_wind[i, :] = col[8::8]  # Grabs every 8th value
-            dispersion[i, :] = col[9::8]
-            cnr[i, :] = col[10::8]
-        except ValueError:
-            print "Value error in line {} for file {}".format(i, in_file)
-
-    # Create the filename
-    date = datetime.utcfromtimestamp(time[0])
-    if 'RHI' in in_file:
-        scan = '_RHI'
-    elif 'PPI' in in_file:
-        scan = '_PPI'
-    elif 'LOS' in in_file:
-        scan = '_LOS'
-    else:
-        scan = ''
 
-    filename = "{prefix}{scan}_{date}.nc".format(prefix=out_prefix, date=date.strftime("%Y%m%d_%H%M%S"), scan=scan)
-    filename = os.path.join(out_dir, filename)
+def _setup_nc(filename, attrs, date, range, chunked=False):
+    """
+    Creates the netcdf and all its variables. The data gets added with _write_rows.
+    :param filename: Name of the netcdf
+    :param attrs: Attributes from the header
+    :param date: Time of the first line
+    :param range: Array of the range gates
+    :param chunked: Compress the variables and chunk them by CHUNK_ROWS lines, for
+                    writing big files a block at a time
+    :return: netCDF4.Dataset
+    """
+    num_ranges = len(range)
 
-    # Create the netcdf
     nc = netCDF4.Dataset(filename, 'w')
 
     # Add attributes
@@ -114,44 +224,240 @@ def process_file(in_file, out_dir, out_prefix):
     nc.createDimension('time', size=None)
     nc.createDimension('range', size=num_ranges)
 
+    if chunked:
+        # Level 1 gets nearly all of the size reduction for a lot less time than the default
+        opts_1d = {'zlib': True, 'complevel': 1, 'chunksizes': (CHUNK_ROWS,)}
+        opts_2d = {'zlib': True, 'complevel': 1, 'shuffle': True, 'chunksizes': (CHUNK_ROWS, num_ranges)}
+    else:
+        opts_1d = {}
+        opts_2d = {}
+
     # Create the variables
-    ncvar = nc.createVariable('epoch_time', 'i8', dimensions=('time',), fill_value=MISSING_DATA_VALUE)
+    ncvar = nc.createVariable('epoch_time', 'i8', dimensions=('time',), fill_value=MISSING_DATA_VALUE, **opts_1d)
     ncvar.setncattr('units', 'seconds')
     ncvar.setncattr('long_name', 'Time since 1 Jan 1970 at 00:00:00 UTC in seconds')
-    ncvar[:] = time[:]
 
     ncvar = nc.createVariable('range', 'f8', dimensions=('range',), fill_value=MISSING_DATA_VALUE)
     ncvar.setncattr('units', 'meters')
     ncvar.setncattr('long_name', 'Distance to range gate')
     ncvar[:] = range[:]
 
-    ncvar = nc.createVariable('azimuth', 'f8', dimensions=('time', 'range'), fill_value=MISSING_DATA_VALUE)
+    ncvar = nc.createVariable('azimuth', 'f8', dimensions=('time', 'range'), fill_value=MISSING_DATA_VALUE, **opts_2d)
     ncvar.setncattr('units', 'degrees')
     ncvar.setncattr('long_name', 'Azimuth angle')
-    ncvar[:] = azimuth[:]
 
-    ncvar = nc.createVariable('elevation', 'f8', dimensions=('time', 'range'), fill_value=MISSING_DATA_VALUE)
+    ncvar = nc.createVariable('elevation', 'f8', dimensions=('time', 'range'), fill_value=MISSING_DATA_VALUE,
+                              **opts_2d)
     ncvar.setncattr('units', 'degrees')
     ncvar.setncattr('long_name', 'Elevation angle')
-    ncvar[:] = elevation[:]
 
-    ncvar = nc.createVariable('radial_wind', 'f8', dimensions=('time', 'range'), fill_value=MISSING_DATA_VALUE)
+    ncvar = nc.createVariable('radial_wind', 'f8', dimensions=('time', 'range'), fill_value=MISSING_DATA_VALUE,
+                              **opts_2d)
     ncvar.setncattr('units', 'm/s')
     ncvar.setncattr('long_name', 'Radial wind speed')
-    ncvar[:] = radial_wind[:]
 
-    ncvar = nc.createVariable('dispersion', 'f8', dimensions=('time', 'range'), fill_value=MISSING_DATA_VALUE)
+    ncvar = nc.createVariable('dispersion', 'f8', dimensions=('time', 'range'), fill_value=MISSING_DATA_VALUE,
+                              **opts_2d)
     ncvar.setncattr('units', 'm/s')
     ncvar.setncattr('long_name', 'Radial wind speed dispersion')
-    ncvar[:] = dispersion[:]
 
-    ncvar = nc.createVariable('cnr', 'f8', dimensions=('time', 'range'), fill_value=MISSING_DATA_VALUE)
+    ncvar = nc.createVariable('cnr', 'f8', dimensions=('time', 'range'), fill_value=MISSING_DATA_VALUE, **opts_2d)
     ncvar.setncattr('units', 'dB')
     ncvar.setncattr('long_name', 'Carrier to noise ratio')
-    ncvar[:] = cnr[:]
+
+    return nc
+
+
+def _write_rows(nc, rays):
+    """
+    Appends parsed lines (from parse_lines) to the end of the time dimension
+    :return: Number of lines written
+    """
+    start = len(nc.dimensions['time'])
+    end = start + rays['time'].size
+
+    nc['epoch_time'][start:end] = rays['time']
+    for var in ['azimuth', 'elevation', 'radial_wind', 'dispersion', 'cnr']:
+        nc[var][start:end] = rays[var]
+
+    return end - start
+
+
+def _serial_blocks(f, num_ranges, in_file, batch_size=None):
+    """
+    Parses the data lines from an open file (positioned after the header)
+    :param batch_size: Number of lines in each block. If None, the whole file is one block.
+    :return: Generator of parse_lines outputs in file order
+    """
+    num_lines = 0
+    while True:
+        if batch_size is None:
+            lines = f.read().splitlines()
+        else:
+            lines = list(islice(f, batch_size))
+
+        if not lines:
+            break
+
+        rays = parse_lines(lines, num_ranges, in_file, first_line=num_lines)
+        num_lines += len(lines)
+        del lines
+
+        yield rays
+
+        if batch_size is None:
+            break
+
+
+def _split_ranges(in_file, data_start, split_size):
+    """
+    Splits the data section of a file into byte ranges of about split_size bytes that
+    start and end on line boundaries
+    :return: List of (start, end, first_line) tuples, where first_line is the number of the
+             first data line in the range
+    """
+    ranges = []
+    with open(in_file, 'rb') as f:
+        f.seek(data_start)
+
+        start = data_start
+        first_line = 0
+        while True:
+            block = f.read(split_size)
+            if not block:
+                break
+
+            # Finish off the last line so the next range starts on a new one
+            block += f.readline()
+
+            ranges.append((start, start + len(block), first_line))
+            start += len(block)
+            first_line += block.count('\n')
+
+    return ranges
+
+
+def _parse_range(job):
+    """
+    Worker for _parallel_blocks. Parses one byte range of the file and saves the arrays to
+    memory mapped .npy files so they don't have to be pickled back to the main process.
+    :param job: (in_file, start, end, first_line, num_ranges, tmp_dir) tuple
+    :return: (dictionary of variable name -> .npy file, traceback or None)
+    """
+    in_file, start, end, first_line, num_ranges, tmp_dir = job
+
+    try:
+        with open(in_file, 'rb') as f:
+            f.seek(start)
+            lines = f.read(end - start).splitlines()
+
+        rays = parse_lines(lines, num_ranges, in_file, first_line=first_line)
+        del lines
+
+        files = {}
+        for var, data in rays.items():
+            files[var] = os.path.join(tmp_dir, '{}_{}.npy'.format(start, var))
+            np.save(files[var], data)
+
+        return files, None
+    except Exception:
+        return None, traceback.format_exc()
+
+
+def _parallel_blocks(in_file, data_start, num_ranges, jobs, split_size=SPLIT_SIZE):
+    """
+    Parses the data section of a file in a process pool. The file is split into byte
+    ranges on line boundaries and each worker parses one range at a time. Only a few
+    ranges are in flight at once so memory stays bounded.
+    :return: Generator of parse_lines outputs in file order
+    """
+    tmp_dir = tempfile.mkdtemp(prefix='los_', dir=SHARED_DIR if os.path.isdir(SHARED_DIR) else None)
+    pool = multiprocessing.Pool(jobs)
+
+    try:
+        ranges = deque((in_file, start, end, first_line, num_ranges, tmp_dir)
+                       for start, end, first_line in _split_ranges(in_file, data_start, split_size))
+        pending = deque()
+
+        while ranges or pending:
+            while ranges and len(pending) < 2 * jobs:
+                pending.append(pool.apply_async(_parse_range, (ranges.popleft(),)))
+
+            # Results are taken in order, so the netcdf gets written in order
+            files, error = pending.popleft().get()
+            if error is not None:
+                raise ValueError("Failed to parse part of {}\n{}".format(in_file, error))
+
+            rays = dict((var, np.load(filename, mmap_mode='r')) for var, filename in files.items())
+            yield rays
+
+            del rays
+            for filename in files.values():
+                os.remove(filename)
+
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def process_file(in_file, out_dir, out_prefix, batch_size=None, jobs=1):
+    """
+    Converts a los file to netcdf
+    :param in_file: File to convert
+    :param out_dir: Directory to write the netcdf to
+    :param out_prefix: Prefix for the netcdf filename
+    :param batch_size: Number of lines to convert at a time. If None, the whole file is read
+                       at once. Otherwise only batch_size lines are held in memory, each batch
+                       is appended to the netcdf as it's parsed, and the netcdf is compressed
+                       and chunked.
+    :param jobs: Number of processes to parse the file with. More than 1 splits the file into
+                 ranges that are parsed in parallel (see _parallel_blocks) and writes the
+                 compressed and chunked netcdf like batch_size does.
+    :return: Name of the netcdf
+    """
+    if 'RHI' in in_file:
+        scan = '_RHI'
+    elif 'PPI' in in_file:
+        scan = '_PPI'
+    elif 'LOS' in in_file:
+        scan = '_LOS'
+    else:
+        scan = ''
+
+    nc = None
+    with open(in_file) as f:
+        # Read in the header. The line after the header has the column names.
+        attrs, range = _read_header(f)
+
+        if jobs > 1:
+            blocks = _parallel_blocks(in_file, f.tell(), len(range), jobs)
+        else:
+            blocks = _serial_blocks(f, len(range), in_file, batch_size=batch_size)
+
+        for rays in blocks:
+            # The filename comes from the time of the first line, so wait until that's parsed
+            # to create the netcdf. It gets a temporary name until it's finished.
+            if nc is None:
+                date = datetime.utcfromtimestamp(rays['time'][0])
+
+                filename = "{prefix}{scan}_{date}.nc".format(prefix=out_prefix, date=date.strftime("%Y%m%d_%H%M%S"),
+                                                            scan=scan)
+                filename = os.path.join(out_dir, filename)
+
+                nc = _setup_nc(filename + '.tmp', attrs, date, range, chunked=batch_size is not None or jobs > 1)
+
+            _write_rows(nc, rays)
+
+    if nc is None:
+        raise ValueError("No data in {}".format(in_file))
 
     # Close the netcdf
     nc.close()
+    os.rename(filename + '.tmp', filename)
+
+    return filename
 
 
 if __name__ == '__main__':
@@ -161,12 +467,16 @@ if __name__ == '__main__':
     parser.add_argument('-i', dest='in_file', nargs='*')
     parser.add_argument('-O', dest='out_prefix', default='los')
     parser.add_argument('-o', dest='out_dir', default=os.getcwd())
+    parser.add_argument('-b', '--batch-size', dest='batch_size', type=int, default=None,
+                        help='Convert this many lines at a time to keep memory use down on large files')
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=1,
+                        help='Number of processes to parse each file with')
 
     args = parser.parse_args()
 
     try:
         for f in args.in_file:
-            process_file(f, args.out_dir, args.out_prefix)
+            process_file(f, args.out_dir, args.out_prefix, batch_size=args.batch_size, jobs=args.jobs)
 
     except Exception:
         print args.in_file
@@ -1,6 +1,7 @@
 # System packages
 import argparse
 import os
+import sys
 
 from datetime import datetime, timedelta, date
 from glob import glob
@@ -9,8 +10,13 @@ from glob import glob
 import netCDF4
 import numpy as np
 
+import nc_catalog
+
 FILL_VALUE = -9999.0
 
+# Files to take data from have a YYYYmmdd date somewhere in their names
+FILE_PATTERN = '*' + '[0-9]' * 8 + '*'
+
 
 def write_variables(nc, variables):
     """
@@ -61,8 +67,11 @@ def setup_new_nc(out_file, nc):
             nc_var = new_nc.createVariable(varname=tmp_var.name, datatype=tmp_var.datatype, dimensions=tmp_var.dimensions,
                                            fill_value=FILL_VALUE)
 
-            # Set the attrs for the variable
+            # Set the attrs for the variable. The fill value was already set when it was created
             for attr in tmp_var.ncattrs():
+                if attr == '_FillValue':
+                    continue
+
                 tmp = tmp_var.getncattr(attr)
                 nc_var.setncattr(attr, tmp)
 
@@ -76,16 +85,30 @@ def setup_new_nc(out_file, nc):
     return new_nc, variables
 
 
-def process_files(start, end, dir, out_file):
+def time_range(epoch, start, end):
     """
-    This function does the heavy lifting. It'll do blah blah
+    Finds the times between start and end with a binary search. Files with times out of
+    order (or missing) are rare, but fall back to checking every time.
+    :param epoch: Array of times in seconds since 1970
     :param start: Start datetime object
     :param end: End datetime object
-    :param dir: Directory condtaining the files to process
-    :param out_file: Filename of the new netcdf
-    :return: None
+    :return: Slice of the times that are after start and before end, or an array of their
+             indices if the times aren't sorted
     """
+    start = nc_catalog.to_epoch(start)
+    end = nc_catalog.to_epoch(end)
+
+    with np.errstate(invalid='ignore'):
+        if not np.all(np.diff(epoch) >= 0):
+            return np.flatnonzero((epoch > start) & (epoch < end))
+
+    return slice(np.searchsorted(epoch, start, side='right'), np.searchsorted(epoch, end, side='left'))
 
+
+def _day_files(start, end, dir):
+    """
+    Gets the files for each day between start and end from the dates in their names
+    """
     # Do some garbage to get the right days in string format
     tmp_start = date(start.year, start.month, start.day)
     tmp_end = date(end.year, end.month, end.day)
@@ -93,49 +116,178 @@ def process_files(start, end, dir, out_file):
     days.sort()
     del tmp_start, tmp_end
 
-    first = True
-    # Get the correct files
+    files = []
     for day in days:
-        files = glob(os.path.join(dir, day.strftime("*%Y%m%d*")))
-        if len(files) == 0:
+        day_files = glob(os.path.join(dir, day.strftime("*%Y%m%d*")))
+        if len(day_files) == 0:
             raise Exception("No files found!")
+        files += day_files
+
+    return files
 
-        # Process the files
-        for f in files:
-            # Open the netcdf
-            nc = netCDF4.Dataset(f, 'r')
 
-            # If this is the first loop, set up the new netcdf
-            if first:
-                new_nc, variables = setup_new_nc(out_file, nc)
-                first = False
+class IopWriter(object):
+    """
+    Writes the data for one IOP to a new netcdf. The new netcdf is set up from the first
+    file added, and each file's times are appended to the time dimension as they come in,
+    so only one file's worth of data is held at a time.
+    """
 
-            # Get the times
-            epoch_list = np.asarray([nc.variables['base_time'] + x for x in nc.variables['time_offset']])
-            dt_list = np.asarray([datetime.utcfromtimestamp(x) for x in epoch_list])
+    def __init__(self, out_file):
+        """
+        :param out_file: Filename of the new netcdf
+        """
+        self.out_file = out_file
+        self._nc = None
+        self._num_times = 0
+
+    def add(self, nc, epoch_list, ind):
+        """
+        Appends the times selected by ind from a file
+        :param nc: Netcdf object of the input file
+        :param epoch_list: Times in the file in seconds since 1970
+        :param ind: Index of the times to keep
+        """
+        # If this is the first file, set up the new netcdf
+        if self._nc is None:
+            self._nc, variables = setup_new_nc(self.out_file, nc)
+
+            # Variables that don't go along time only need writing once
+            for var in variables:
+                nc_var = self._nc.variables[var]
+                if var == 'epoch_time' or nc_var.dimensions[:1] == ('time',):
+                    continue
+                elif nc_var.shape == ():
+                    nc_var.assignValue(FILL_VALUE)
+                else:
+                    nc_var[:] = nc[var][:]
 
+        epoch_time = epoch_list[ind]
+        if len(epoch_time) == 0:
+            return
 
-            # Get the indicies that match the dates
-            ind = np.logical_and(dt_list > start, dt_list < end)
+        # Since epoch time isn't in the original netcdf, this has to be done separate
+        times = slice(self._num_times, self._num_times + len(epoch_time))
+        self._nc.variables['epoch_time'][times] = epoch_time
 
-            for var in variables.keys():
+        for var in self._nc.variables:
+            if var != 'epoch_time' and self._nc.variables[var].dimensions[:1] == ('time',):
+                self._nc.variables[var][times] = nc[var][ind]
 
-                if var == 'epoch_time':
-                    # Since epoch time isn't in the original netcdf, this has to be done separate
-                    variables[var] += list(epoch_list[ind])
-                elif var == 'height':
-                    variables[var] += list(nc[var][:])
-                elif nc[var].shape != ():
-                    variables[var] += list(nc[var][ind])
-                else:
-                    variables[var] += [FILL_VALUE]
+        self._num_times = times.stop
 
+    def close(self):
+        if self._nc is not None:
+            self._nc.close()
+            self._nc = None
+
+
+def process_iops(iops, dir, catalog=None, update=True):
+    """
+    Extracts a batch of IOPs in one pass over the files. Each file is opened once and its
+    data goes to every IOP it overlaps.
+    :param iops: List of (name, start, end, out_file) tuples. start and end are datetime objects.
+    :param dir: Directory condtaining the files to process
+    :param catalog: nc_catalog.Catalog to find the files with, same as process_files
+    :param update: Bring the catalog up to date with dir first
+    :return: Dictionary of the sys.exc_info() for the IOPs that failed, keyed by name
+    """
+    failed = {}
+    if len(iops) == 0:
+        return failed
+
+    # Work out which IOPs want each file
+    if catalog is not None and update:
+        catalog.update(dir, pattern=FILE_PATTERN)
+
+    file_iops = {}
+    for iop in iops:
+        name, start, end, out_file = iop
+        try:
+            if catalog is not None:
+                files = catalog.files(start, end, dir, pattern=FILE_PATTERN)
+                if len(files) == 0:
+                    raise Exception("No files found!")
+            else:
+                files = _day_files(start, end, dir)
+        except Exception:
+            failed[name] = sys.exc_info()
+            continue
+
+        for f in files:
+            file_iops.setdefault(f, []).append(iop)
+
+    if catalog is not None:
+        file_order = dict((f, i) for i, f in enumerate(catalog.files(min(iop[1] for iop in iops),
+                                                                      max(iop[2] for iop in iops), dir,
+                                                                      pattern=FILE_PATTERN)))
+        files = sorted(file_iops, key=lambda f: (file_order.get(f), f))
+    else:
+        files = sorted(file_iops)
+
+    writers = dict((iop[0], IopWriter(iop[3])) for iop in iops if iop[0] not in failed)
+
+    # Process the files
+    for f in files:
+        nc = None
+        try:
+            try:
+                # Open the netcdf
+                nc = netCDF4.Dataset(f, 'r')
+
+                # Get the times
+                epoch_list = nc_catalog.file_times(nc)
+            except Exception:
+                # None of the IOPs that want this file can be finished
+                exc_info = sys.exc_info()
+                for name, start, end, out_file in file_iops[f]:
+                    if name not in failed:
+                        failed[name] = exc_info
+                        writers.pop(name).close()
+                continue
+
+            for name, start, end, out_file in file_iops[f]:
+                if name in failed:
+                    continue
+
+                try:
+                    # Only the part of the file in the IOP is read
+                    writers[name].add(nc, epoch_list, time_range(epoch_list, start, end))
+                except Exception:
+                    failed[name] = sys.exc_info()
+                    writers.pop(name).close()
+        finally:
             # Close the netcdf
-            nc.close()
+            if nc is not None:
+                nc.close()
+
+    for name, writer in writers.items():
+        try:
+            writer.close()
+        except Exception:
+            failed[name] = sys.exc_info()
 
-    write_variables(new_nc, variables)
+    return failed
 
-    new_nc.close()
+
+def process_files(start, end, dir, out_file, catalog=None, update=True):
+    """
+    This function does the heavy lifting. It'll do blah blah
+    :param start: Start datetime object
+    :param end: End datetime object
+    :param dir: Directory condtaining the files to process
+    :param out_file: Filename of the new netcdf
+    :param catalog: nc_catalog.Catalog to find the files with. It's brought up to date with
+                    dir and only the files overlapping start to end are opened. Without one
+                    the files are found by the dates in their names.
+    :param update: Bring the catalog up to date with dir first. Turn off if it already is.
+    :return: None
+    """
+    failed = process_iops([(out_file, start, end, out_file)], dir, catalog=catalog, update=update)
+
+    if out_file in failed:
+        exc_type, exc, tb = failed[out_file]
+        raise exc_type, exc, tb
 
 
 if __name__=='__main__':
@@ -147,10 +299,19 @@ if __name__=='__main__':
     parser.add_argument('-d', dest='dir', help='Directory containing the netcdf files (assumes date is somewhere '
                                                'in file name in format YYYYmmdd)', required=True)
     parser.add_argument('-o', dest='out_file', help='File to write to', required=True)
+    parser.add_argument('--catalog', dest='catalog', default=None,
+                        help='Catalog of the files in the directory (default: {} in the '
+                             'directory)'.format(nc_catalog.CATALOG_NAME))
+    parser.add_argument('--no-catalog', dest='use_catalog', action='store_false',
+                        help='Find the files by the dates in their names instead of using a catalog')
     args = parser.parse_args()
 
     # Turn dates to datetime objects
     start_date = datetime.strptime(args.start_date, "%Y%m%d-%H%M")
     end_date = datetime.strptime(args.end_date, "%Y%m%d-%H%M")
 
-    process_files(start_date, end_date, args.dir, args.out_file)
\ No newline at end of file
+    catalog = None
+    if args.use_catalog:
+        catalog = nc_catalog.Catalog(args.catalog or os.path.join(args.dir, nc_catalog.CATALOG_NAME))
+
+    process_files(start_date, end_date, args.dir, args.out_file, catalog=catalog)
\ No newline at end of file
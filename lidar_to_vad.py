@@ -8,7 +8,11 @@ Author: Tyler Bell (March 2017)
 """
 
 import argparse
+import hashlib
+import multiprocessing
 import os
+import traceback
+from collections import OrderedDict, deque
 from datetime import datetime
 
 import matplotlib.pyplot as plt
@@ -17,14 +21,24 @@ import numpy as np
 
 from numpy import sin, cos
 
+import beam_geometry
+
 
 # Global Values
 FILL_VALUE = -9999.
 VEL_LIM = (-30, 30)
 HGT_LIM = (0, 1000)
 PROFILES_PER_PLOT = 2
-Re = 6371000
-R43 = Re * 4.0 / 3.0
+CHUNK_PROFILES = 64  # Number of profiles in each chunk of the daily time-height files
+
+# Scan geometries are cached so the trig and normal matrix only get computed once per scan pattern
+GEOMETRY_CACHE_SIZE = 16
+ANGLE_QUANTUM = 0.01  # Angles are rounded to this many degrees for the cache key (halo reports 2 decimals)
+_geometry_cache = OrderedDict()
+
+# The running VAD sums are added up again from scratch after this many scans so rounding
+# errors from adding and subtracting scans don't build up over a long run
+RESUM_SCANS = 100
 
 var_lookup = {'leo':
                   {
@@ -56,48 +70,25 @@ var_lookup = {'leo':
              }
 
 
-def _ray_height(rng, elev, H0=0, R1=R43):
-    """
-    Center of radar beam height calculation.
-    Rinehart (1997), Eqn 3.12, Bech et al. (2003) Eqn 3
-    INPUT::
-    -----
-    r : float
-        Range from radar to point of interest [m]
-    elev : float
-        Elevation angle of radar beam [deg]
-    H0 : float
-        Height of radar antenna [m]
-    R1 : float
-        Effective radius
-    OUTPUT::
-    -----
-    H : float
-        Radar beam height [m]
-    USAGE::
-    -----
-    H = ray_height(r,elev,H0,[R1=6374000.*4/3])
-    NOTES::
-    -----
-    If no Effective radius is given a "standard atmosphere" is assumed,
-       the 4/3 approximation.
-    Bech et al. (2003) use a factor ke that is the ratio of earth's radius
-       to the effective radius (see r_effective function) and Eqn 4 in B03
-    """
-
-    # Convert earth's radius to km for common dN/dH values and then
-    # multiply by 1000 to return radius in meters
-    hgt = np.sqrt(rng ** 2 + R1 ** 2 + 2 * rng * R1 * np.sin(np.deg2rad(elev)))
-    hgt = hgt - R1 + H0
-
-    return hgt
-
-
 def _list_to_masked_array(in_list, mask_value):
     a = np.array(in_list)
     return np.ma.masked_where(a == mask_value, a)
 
 
+def _read_scan_var(var):
+    """
+    Reads a whole netcdf variable as a (nbeams, nrange) array. Per ray variables, like the
+    angles in compact halo files, only have a time dimension and are the same for every gate,
+    so they come back as (nbeams, 1) to broadcast against the gates.
+    """
+    values = var[:]
+
+    if values.ndim == 1:
+        return values[:, np.newaxis]
+
+    return values
+
+
 def calc_vad_3d(az, elev, vel):
     """
     IN DEVELOPMENT DO NOT USE
@@ -143,17 +134,319 @@ def calc_vad_3d(az, elev, vel):
         return FILL_VALUE, FILL_VALUE, FILL_VALUE
 
 
-def calc_homogeneity(raw_vr, derived_vr):
+def _beam_angles(angle):
+    """
+    Returns the angle of each beam as a 1-D array if it's the same for every range gate
+    (which it always is for the lidars), otherwise the (nbeams, nrange) array as is
+    """
+    angle = np.ma.filled(angle, FILL_VALUE)
+
+    if angle.ndim == 1:
+        return angle
+
+    if np.all(angle == angle[:, :1]):
+        return angle[:, 0]
+
+    return angle
+
+
+def _geometry_terms(az, elev):
+    """
+    Gets the trig terms and normal matrix for a scan geometry. These only depend on the
+    angles, which are the same for every scan in a deployment, so they're kept in a small
+    LRU cache keyed on the (quantized) azimuths and elevations.
+    :param az: 1-D array of the azimuth of each beam [deg]
+    :param elev: 1-D array of the elevation of each beam [deg]
+    :return: Dictionary of the terms. 'beam_terms' is the (nbeams, 3, 3) contribution of each
+             beam to the calc_vad_3d matrix and 'full' is the matrix with every beam.
+    """
+    quantized = np.round(np.concatenate((az, elev)) / ANGLE_QUANTUM).astype(np.int64)
+    key = (az.size, hashlib.sha1(quantized.tostring()).hexdigest())
+
+    if key in _geometry_cache:
+        # Move it to the end so it's the most recently used
+        terms = _geometry_cache.pop(key)
+        _geometry_cache[key] = terms
+        return terms
+
+    az_rad = np.deg2rad(az)
+    elev_rad = np.deg2rad(elev)
+
+    sin_az = sin(az_rad)
+    cos_az = cos(az_rad)
+    sin_el = sin(elev_rad)
+    cos_el = cos(elev_rad)
+
+    # Each beam's part of the calc_vad_3d sums, laid out like its matrix
+    beam_terms = np.empty((az.size, 3, 3))
+    beam_terms[:, 0, 0] = sin_az ** 2 * cos_el      # B
+    beam_terms[:, 0, 1] = sin_az * cos_az * cos_el  # E
+    beam_terms[:, 0, 2] = sin_az * cos_el           # X
+    beam_terms[:, 1, 0] = cos_az * sin_az * cos_el  # C
+    beam_terms[:, 1, 1] = cos_az ** 2 * cos_el      # F
+    beam_terms[:, 1, 2] = cos_az * cos_el           # Y
+    beam_terms[:, 2, 0] = sin_az * sin_el           # G
+    beam_terms[:, 2, 1] = cos_az * sin_el           # H
+    beam_terms[:, 2, 2] = az_rad * sin_el           # Z
+
+    terms = {'sin_az': sin_az[:, np.newaxis],
+             'cos_az': cos_az[:, np.newaxis],
+             'sin_el': sin_el[:, np.newaxis],
+             'cos_el': cos_el[:, np.newaxis],
+             'beam_terms': beam_terms,
+             'full': beam_terms.sum(axis=0),
+             # Multiplying these by the velocity gives the right hand side (A, D, W)
+             'rhs_terms': np.column_stack((sin_az, cos_az, np.ones(az.size)))}
+
+    _geometry_cache[key] = terms
+    if len(_geometry_cache) > GEOMETRY_CACHE_SIZE:
+        _geometry_cache.popitem(last=False)
+
+    return terms
+
+
+def _normal_equations(az, elev, vel, valid):
+    """
+    Builds the calc_vad_3d system for every gate from (nbeams, nrange) angles
+    :return: y, z, and the trig terms needed for the derived radial velocity
+    """
+    az = np.deg2rad(np.ma.filled(az, 0.))
+    elev = np.deg2rad(np.ma.filled(elev, 0.)) * np.ones(az.shape)
+
+    # Masked beams get zero weight in all the sums
+    weight = valid.astype(float)
+    raw_vel = np.ma.filled(vel, 0.)
+
+    sin_az = sin(az) * weight
+    cos_az = cos(az) * weight
+    sin_el = sin(elev)
+    cos_el = cos(elev)
+
+    A = np.sum(raw_vel * sin_az, axis=0)
+    B = np.sum(sin_az ** 2 * cos_el, axis=0)
+    C = np.sum(cos_az * sin_az * cos_el, axis=0)
+    G = np.sum(sin_az * sin_el, axis=0)
+
+    D = np.sum(raw_vel * cos_az, axis=0)
+    E = np.sum(sin_az * cos_az * cos_el, axis=0)
+    F = np.sum(cos_az ** 2 * cos_el, axis=0)
+    H = np.sum(cos_az * sin_el, axis=0)
+
+    W = np.sum(raw_vel * weight, axis=0)
+    X = np.sum(sin_az * cos_el, axis=0)
+    Y = np.sum(cos_az * cos_el, axis=0)
+    Z = np.sum(az * weight * sin_el, axis=0)
+
+    # Same system as calc_vad_3d, one per gate
+    y = np.empty((az.shape[1], 3, 3))
+    y[:, 0, 0], y[:, 0, 1], y[:, 0, 2] = B, E, X
+    y[:, 1, 0], y[:, 1, 1], y[:, 1, 2] = C, F, Y
+    y[:, 2, 0], y[:, 2, 1], y[:, 2, 2] = G, H, Z
+    z = np.column_stack((A, D, W))
+
+    return y, z, sin(az), cos(az), sin_el, cos_el
+
+
+def _normal_equations_cached(az, elev, vel, valid):
+    """
+    Same as _normal_equations for scans where each beam has one azimuth and elevation.
+    The matrix with every beam comes from the geometry cache, and gates with masked
+    beams have those beams' contributions taken back out of it.
+    """
+    terms = _geometry_terms(az, elev)
+    num_beams, num_gates = valid.shape
+
+    beam_terms = terms['beam_terms'].reshape((num_beams, 9))
+    num_valid = np.sum(valid, axis=0)
+
+    y = np.tile(terms['full'], (num_gates, 1, 1))
+
+    # Take the masked beams out of the full matrix. If most of a gate's beams are masked
+    # it's quicker (and more accurate) to add up the good ones instead.
+    rebuild = num_valid < num_beams - num_valid
+    subtract = np.logical_and(~rebuild, num_valid < num_beams)
+
+    if np.any(rebuild):
+        y[rebuild] = np.dot(valid[:, rebuild].transpose(), beam_terms).reshape((-1, 3, 3))
+    if np.any(subtract):
+        y[subtract] -= np.dot(~valid[:, subtract].transpose(), beam_terms).reshape((-1, 3, 3))
+
+    z = np.dot(np.ma.filled(vel, 0.).transpose(), terms['rhs_terms'])
+
+    return y, z, terms['sin_az'], terms['cos_az'], terms['sin_el'], terms['cos_el']
+
+
+def _scan_equations(az, elev, vel):
+    """
+    Builds the calc_vad_3d system for every gate of a scan, using the geometry cache when
+    there is one angle per beam
+    :return: vel (masked), valid beams, y, z, and the trig terms for the derived radial velocity
+    """
+    if np.ndim(az) == 1 and np.ndim(elev) == 1:
+        vel = np.ma.masked_array(vel)
+        valid = ~np.ma.getmaskarray(vel)
+        y, z, sin_az, cos_az, sin_el, cos_el = _normal_equations_cached(np.asarray(az), np.asarray(elev), vel, valid)
+    else:
+        vel = np.ma.masked_array(vel, mask=np.ma.getmaskarray(vel) | np.ma.getmaskarray(az))
+        valid = ~np.ma.getmaskarray(vel)
+        y, z, sin_az, cos_az, sin_el, cos_el = _normal_equations(az, elev, vel, valid)
+
+    return vel, valid, y, z, sin_az, cos_az, sin_el, cos_el
+
+
+def _solve_normal_equations(y, z, num_valid):
+    """
+    Solves the (nrange, 3, 3) stack of systems in one go
+    :return: (nrange, 3) array of u, v, w. FILL_VALUE where there isn't a solution.
+    """
+    # A singular matrix would make the whole stacked solve fail, so pick those out first
+    solvable = np.logical_and(num_valid > 1, np.linalg.det(y) != 0)
+
+    sol = np.full((y.shape[0], 3), FILL_VALUE)
+    if np.any(solvable):
+        sol[solvable] = np.linalg.solve(y[solvable], z[solvable])
+
+    return sol
+
+
+def _solve_sums(sums):
+    """
+    Solves the VAD from the sums kept by VadAccumulator and calc_vad_3d_binned
+    :param sums: Dictionary with the normal equations (y, z), the number of good beams (n)
+                 and the sums for the RMSE and homogeneity (s_vv, s_va, s_aa)
+    :return: u, v, w, rmse, r_sq like calc_vad_3d_all
+    """
+    sol = _solve_normal_equations(sums['y'], sums['z'], sums['n'])
+
+    # Sum of the squared errors, sum((vel - a.sol)**2), from the sums
+    sse = sums['s_vv'] - 2 * np.sum(sol * sums['s_va'], axis=1) + np.einsum('gj,gjk,gk->g', sol, sums['s_aa'], sol)
+    sse = np.maximum(sse, 0)
+
+    # Same as calc_homogeneity (which uses the sum of the velocities for vr_bar)
+    vr_bar = sums['z'][:, 2]
+    sst = sums['s_vv'] - 2 * vr_bar ** 2 + sums['n'] * vr_bar ** 2
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rmse = np.where(sums['n'] > 0, np.sqrt(sse / sums['n']), np.nan)
+        r_sq = np.where(sums['n'] > 0, 1 - sse / sst, np.nan)
+
+    return sol[:, 0], sol[:, 1], sol[:, 2], rmse, r_sq
+
+
+def calc_vad_3d_all(az, elev, vel):
+    """
+    Does the same retrieval as calc_vad_3d for every range gate at once. The sums for
+    each gate are built with array operations and the 3x3 systems are solved as one
+    (nrange, 3, 3) stack. Masked beams are left out of a gate's sums, so each gate
+    gives the same answer as calc_vad_3d on that gate's unmasked beams.
+
+    If az and elev are 1-D (one angle per beam), the trig terms and normal matrix come
+    from a cache keyed on the scan geometry, so only the velocity sums are done per scan.
+    :param az: (nbeams, nrange) masked array or (nbeams,) array of azimuths [deg]
+    :param elev: (nbeams, nrange) or (nbeams,) array of elevations [deg]
+    :param vel: (nbeams, nrange) masked array of radial velocities
+    :return:
+    u, v, w - Arrays of the wind components for each gate. FILL_VALUE where there isn't a solution.
+    rmse - Array of the rms error of the fit for each gate
+    r_sq - Array of the homogeneity (calc_homogeneity) for each gate
+    """
+    vel, valid, y, z, sin_az, cos_az, sin_el, cos_el = _scan_equations(az, elev, vel)
+    num_valid = np.sum(valid, axis=0)
+
+    sol = _solve_normal_equations(y, z, num_valid)
+
+    u = sol[:, 0]
+    v = sol[:, 1]
+    w = sol[:, 2]
+
+    # Calculate the RMSE and homogeneity
+    derived_vr = (sin_az * cos_el * u) + (cos_az * cos_el * v) + (sin_el * w)
+    derived_vr = np.ma.masked_array(derived_vr, mask=~valid)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rmse = np.sqrt(np.ma.sum((vel - derived_vr) ** 2, axis=0) / num_valid)
+        r_sq = calc_homogeneity(vel, derived_vr, axis=0)
+
+    return u, v, w, np.ma.filled(rmse, np.nan), np.ma.filled(r_sq, np.nan)
+
+
+def calc_vad_3d_binned(az, elev, vel, hgt, bin_edges):
+    """
+    Does the calc_vad_3d retrieval on height bins instead of range gates, so samples from
+    scans at different elevations can go into the same profile. Every good sample is
+    dropped into its height bin and the sums for all the bins are done at once with
+    np.bincount, then the systems are solved as one stack like calc_vad_3d_all.
+    :param az: Azimuth of each sample [deg]
+    :param elev: Elevation of each sample [deg]
+    :param vel: Radial velocity of each sample. Masked or NaN samples are left out.
+    :param hgt: Height of each sample [m]
+    :param bin_edges: (nbins+1,) increasing array of bin edges [m]
+    :return: u, v, w, rmse, r_sq for each bin like calc_vad_3d_all
+    """
+    az = np.ma.filled(np.ma.asarray(az, dtype=float), np.nan).ravel()
+    elev = np.ma.filled(np.ma.asarray(elev, dtype=float), np.nan).ravel()
+    vel = np.ma.filled(np.ma.asarray(vel, dtype=float), np.nan).ravel()
+    hgt = np.ma.filled(np.ma.asarray(hgt, dtype=float), np.nan).ravel()
+
+    num_bins = len(bin_edges) - 1
+    bins = np.digitize(hgt, bin_edges) - 1
+
+    good = np.isfinite(az) & np.isfinite(elev) & np.isfinite(vel) & (bins >= 0) & (bins < num_bins)
+    az = np.deg2rad(az[good])
+    elev = np.deg2rad(elev[good])
+    vel = vel[good]
+    bins = bins[good]
+
+    def bin_sum(values):
+        return np.bincount(bins, weights=values, minlength=num_bins)
+
+    sin_az = sin(az)
+    cos_az = cos(az)
+    sin_el = sin(elev)
+    cos_el = cos(elev)
+
+    # Same system as calc_vad_3d, one per bin
+    y = np.empty((num_bins, 3, 3))
+    y[:, 0, 0] = bin_sum(sin_az ** 2 * cos_el)
+    y[:, 0, 1] = bin_sum(sin_az * cos_az * cos_el)
+    y[:, 0, 2] = bin_sum(sin_az * cos_el)
+    y[:, 1, 0] = y[:, 0, 1]
+    y[:, 1, 1] = bin_sum(cos_az ** 2 * cos_el)
+    y[:, 1, 2] = bin_sum(cos_az * cos_el)
+    y[:, 2, 0] = bin_sum(sin_az * sin_el)
+    y[:, 2, 1] = bin_sum(cos_az * sin_el)
+    y[:, 2, 2] = bin_sum(az * sin_el)
+    z = np.column_stack((bin_sum(vel * sin_az), bin_sum(vel * cos_az), bin_sum(vel)))
+
+    # Parts of the fitted radial velocity, vr = a0*u + a1*v + a2*w
+    a = (sin_az * cos_el, cos_az * cos_el, sin_el)
+
+    sums = {'y': y,
+            'z': z,
+            'n': np.bincount(bins, minlength=num_bins),
+            's_vv': bin_sum(vel ** 2),
+            's_va': np.column_stack([bin_sum(vel * a_k) for a_k in a]),
+            's_aa': np.empty((num_bins, 3, 3))}
+
+    for j in range(3):
+        for k in range(j, 3):
+            sums['s_aa'][:, j, k] = sums['s_aa'][:, k, j] = bin_sum(a[j] * a[k])
+
+    return _solve_sums(sums)
+
+
+def calc_homogeneity(raw_vr, derived_vr, axis=None):
     """
     Determines homogeneity of the wind field as described in E. Paschke et. al. 2015 section 2.2.4
     :param raw_vr: Raw radial velocity
     :param derived_vr: Radial velocity derived from wind retrieval
+    :param axis: Axis to sum over. Use axis=0 with (nbeams, nrange) arrays to do every gate at once
     :return:
     """
 
-    vr_bar = np.sum(raw_vr)
+    vr_bar = np.sum(raw_vr, axis=axis)
 
-    return 1 - np.sum((raw_vr - derived_vr)**2) / np.sum((raw_vr - vr_bar)**2)
+    return 1 - np.sum((raw_vr - derived_vr)**2, axis=axis) / np.sum((raw_vr - vr_bar)**2, axis=axis)
 
 
 def calc_vad(az, elev, vel):
@@ -193,68 +486,55 @@ def calc_vad(az, elev, vel):
         return FILL_VALUE, FILL_VALUE, FILL_VALUE
 
 
-def process_file(in_file, system, height=None, sinfit_dir=None):
+def read_scan(in_file, system):
     """
-    Processes a line of sight netcdf file and outputs the vad. If height is specified,
-    it will only return values nearest that height.
-    :param in_file: File to process
+    Reads in what's needed for the VAD from a PPI and filters out the bad values
+    :param in_file: File to read
     :param system: System to use in lookup table
-    :param height: Height to process if desired
-    :param sinfit_loc: Specify if you want to output a sin fit graph. A specific height MUST be specified.
     :return:
+    date - Start time of the scan
+    rng - Array of ranges
+    az, elev - Angles as (nbeams, nrange) arrays, or (nbeams, 1) if the file stores them per ray
+    vel - (nbeams, nrange) masked array of radial velocities with the bad values masked
     """
     # Open the netcdf
     nc = netCDF4.Dataset(in_file)
     date = datetime.strptime(nc.start_time, "%Y-%m-%dT%H:%M:%S")
 
-    hgt = []
-    u = []
-    v = []
-    w = []
-    rmse = []
-    r_sq = []
-
-    for i, range in enumerate(nc[var_lookup[system]['range']][:]):
-
-        # Get the required stuff for this range ring
-        cnr = nc[var_lookup[system]['thresh_var']][:, i].transpose()
-        vel = nc[var_lookup[system]['vel']][:, i].transpose()
-        az = nc[var_lookup[system]['az']][:, i].transpose()
-        elev = nc[var_lookup[system]['elev']][:, i]
+    # Read in each variable for the whole scan once, as (nbeams, nrange) arrays
+    rng = nc[var_lookup[system]['range']][:]
+    cnr = _read_scan_var(nc[var_lookup[system]['thresh_var']])
+    raw_vel = _read_scan_var(nc[var_lookup[system]['vel']])
+    az = _read_scan_var(nc[var_lookup[system]['az']])
+    elev = _read_scan_var(nc[var_lookup[system]['elev']])
 
-        # Filter out the bad values based on CNR
-        az = np.where(cnr <= var_lookup[system]['thresh_value'], FILL_VALUE, az)
-        vel = np.where(cnr <= var_lookup[system]['thresh_value'], FILL_VALUE, vel)
-
-        az = _list_to_masked_array(az, FILL_VALUE)
-        vel = _list_to_masked_array(vel, FILL_VALUE)
-
-        # Calculate the vad and height for this range ring
-        tmp_u, tmp_v, tmp_w = calc_vad_3d(az, elev, vel)
-
-        # Calculate the RMSE
-        N = float(vel.size)
-        az_rad = np.deg2rad(az)
-        elev_rad = np.deg2rad(elev)
+    # Close the netcdf
+    nc.close()
 
-        derived_vr = (sin(az_rad) * cos(elev_rad) * tmp_u) + \
-                     (cos(az_rad) * cos(elev_rad) * tmp_v) + \
-                     (sin(elev_rad) * tmp_w)
+    # Filter out the bad values based on CNR (and beams with missing angles)
+    bad = np.logical_or(cnr <= var_lookup[system]['thresh_value'], np.ma.filled(az, FILL_VALUE) == FILL_VALUE)
+    vel = _list_to_masked_array(np.where(bad, FILL_VALUE, raw_vel), FILL_VALUE)
 
-        tmp_E = vel - derived_vr
+    return date, rng, az, elev, vel
 
-        # Calculate rms error
-        tmp_RMSE = np.sqrt(1 / N * np.sum(tmp_E ** 2))
 
-        tmp_r_sq = calc_homogeneity(vel, derived_vr)
+def process_file(in_file, system, height=None, sinfit_dir=None):
+    """
+    Processes a line of sight netcdf file and outputs the vad. If height is specified,
+    it will only return values nearest that height.
+    :param in_file: File to process
+    :param system: System to use in lookup table
+    :param height: Height to process if desired
+    :param sinfit_loc: Specify if you want to output a sin fit graph. A specific height MUST be specified.
+    :return:
+    """
+    date, rng, raw_az, elev, scan_vel = read_scan(in_file, system)
 
-        # Append to the lists for plotting
-        u.append(tmp_u)
-        v.append(tmp_v)
-        w.append(tmp_w)
-        hgt.append(_ray_height(range, elev[0]))
-        rmse.append(tmp_RMSE)
-        r_sq.append(tmp_r_sq)
+    # Calculate the vad, RMSE and homogeneity for every range ring at once. The angles
+    # are passed in per beam when possible so the scan geometry can be cached
+    u, v, w, rmse, r_sq = calc_vad_3d_all(_beam_angles(raw_az), _beam_angles(elev), scan_vel)
+    hgt = beam_geometry.profile_height(rng, _beam_angles(elev))
+    scan_elev = elev[:, -1]
 
     if height is not None:
         i = (np.abs(np.asarray(hgt) - height)).argmin()
@@ -268,12 +548,11 @@ def process_file(in_file, system, height=None, sinfit_dir=None):
             filename = "sinfit_{height}m_{date}.png".format(height=height, date=date.strftime("%Y%m%d_%H%M%S"))
             filename = os.path.join(sinfit_dir, filename)
 
-            cnr = nc[var_lookup[system]['thresh_var']][:, i].transpose()
-            vel = nc[var_lookup[system]['vel']][:, i].transpose()
-            az = nc[var_lookup[system]['az']][:, i].transpose()
-            elev = np.round(np.mean(nc[var_lookup[system]['elevation']][:, i]), 2)
+            # Per ray angles only have the one column
+            az = raw_az[:, min(i, raw_az.shape[1] - 1)]
+            elev = np.round(np.mean(elev[:, min(i, elev.shape[1] - 1)]), 2)
 
-            vel = np.where(cnr <= var_lookup[system]['thresh_value'], np.nan, vel)
+            vel = np.ma.filled(scan_vel[:, i], np.nan)
 
             az_rad = np.deg2rad(az)
             elev_rad = np.deg2rad(elev)
@@ -289,10 +568,91 @@ def process_file(in_file, system, height=None, sinfit_dir=None):
             plt.savefig(filename)
             plt.close()
 
-    # Close the netcdf
-    nc.close()
+    return u, v, w, hgt, rmse, r_sq, date, scan_elev
+
+
+def combine_scans(scans, bin_size, max_height=None):
+    """
+    Makes one VAD profile from a set of PPIs (usually at different elevations) by putting
+    every sample on a common height grid. Heights come from each beam's own elevation.
+    :param scans: List of outputs from read_scan
+    :param bin_size: Depth of the height bins [m]
+    :param max_height: Top of the height grid [m]. Defaults to the height of the last range
+                       gate pointing straight up, so the grid only depends on the range gates
+                       and not on which elevations went in.
+    :return: Same as process_file. The date is the start of the first scan and elev has the
+             elevation of every beam that went in.
+    """
+    az = []
+    elev = []
+    vel = []
+    hgt = []
+    for date, rng, scan_az, scan_elev, scan_vel in scans:
+        beam_hgt, beam_dist = beam_geometry.lookup(rng, _beam_angles(scan_elev))
+
+        az.append(np.broadcast_to(np.ma.filled(scan_az, np.nan), scan_vel.shape).ravel())
+        elev.append(np.broadcast_to(np.ma.filled(scan_elev, np.nan), scan_vel.shape).ravel())
+        vel.append(np.ma.filled(scan_vel, np.nan).ravel())
+        hgt.append(np.broadcast_to(beam_hgt, scan_vel.shape).ravel())
+
+    hgt = np.concatenate(hgt)
+
+    if max_height is None:
+        max_height = _grid_top(scans)
+
+    bin_edges = np.arange(0, max_height + bin_size, bin_size)
+
+    u, v, w, rmse, r_sq = calc_vad_3d_binned(np.concatenate(az), np.concatenate(elev), np.concatenate(vel), hgt,
+                                             bin_edges)
 
-    return u, v, w, hgt, rmse, r_sq, date, elev
+    date = min(scan[0] for scan in scans)
+    scan_elev = np.concatenate([scan[3][:, -1] for scan in scans])
+
+    return u, v, w, (bin_edges[:-1] + bin_edges[1:]) / 2., rmse, r_sq, date, scan_elev
+
+
+def _grid_top(scans):
+    """
+    Height of the last range gate of a set of scans if it were pointing straight up
+    """
+    return beam_geometry.ray_height(max(np.nanmax(scan[1]) for scan in scans), 90.)
+
+
+def _combine_results(results, window, bin_size, max_height=None):
+    """
+    Groups the read_scan results coming back from _process_worker into blocks of window
+    seconds (from the start of the first scan in the block) and combines each block with
+    combine_scans. Failures (of reading a scan or combining a block) are passed through
+    with their traceback. Every block uses the same height grid, so the profiles can all go
+    in the same file. Without max_height, the top of the grid comes from the first block.
+    :return: Generator of (first file in the block, output of combine_scans, traceback) tuples
+    """
+    def combine(block):
+        try:
+            return block[0][0], combine_scans([scan for name, scan in block], bin_size, max_height), None
+        except Exception:
+            return block[0][0], None, traceback.format_exc()
+
+    block = []
+    for f, result, error in results:
+        if error is not None:
+            yield f, result, error
+            continue
+
+        if block and (result[0] - block[0][1][0]).total_seconds() >= window:
+            if max_height is None:
+                max_height = _grid_top([scan for name, scan in block])
+
+            yield combine(block)
+            block = []
+
+        block.append((f, result))
+
+    if block:
+        if max_height is None:
+            max_height = _grid_top([scan for name, scan in block])
+
+        yield combine(block)
 
 
 def write_to_nc(filename, date, elev, u, v, w, hgt, rmse, r_sq):
@@ -329,6 +689,255 @@ def write_to_nc(filename, date, elev, u, v, w, hgt, rmse, r_sq):
     nc.close()
 
 
+class VadAccumulator(object):
+    """
+    Running VAD over a sliding window of consecutive scans. Keeps the per gate sums from
+    calc_vad_3d (plus the ones needed for the RMSE and homogeneity) for each scan in the
+    window. Adding or dropping a scan only adds or subtracts its sums, and solve() gives
+    the same answer as calc_vad_3d_all on all the scans in the window put together.
+    """
+
+    def __init__(self, window):
+        """
+        :param window: Length of the window in seconds. Scans are dropped once they are
+                       this much older than the newest scan.
+        """
+        if window <= 0:
+            raise ValueError("Window has to be longer than 0 seconds")
+
+        self.window = window
+        self._scans = deque()
+        self._totals = None
+        self._num_updates = 0
+
+    def __len__(self):
+        return len(self._scans)
+
+    @staticmethod
+    def _scan_sums(az, elev, vel):
+        vel, valid, y, z, sin_az, cos_az, sin_el, cos_el = _scan_equations(az, elev, vel)
+        weight = valid.astype(float)
+        raw_vel = np.ma.filled(vel, 0.)
+
+        # Parts of the fitted radial velocity, vr = a0*u + a1*v + a2*w
+        a = np.array(np.broadcast_arrays(sin_az * cos_el * weight, cos_az * cos_el * weight, sin_el * weight))
+
+        return {'y': y,
+                'z': z,
+                'n': np.sum(valid, axis=0),
+                's_vv': np.sum(raw_vel ** 2, axis=0),
+                's_va': np.einsum('bg,kbg->gk', raw_vel, a),
+                's_aa': np.einsum('jbg,kbg->gjk', a, a)}
+
+    def add(self, date, az, elev, vel):
+        """
+        Adds a scan to the window and drops the scans that have fallen out of it
+        :param date: Time of the scan
+        :param az, elev, vel: Same as calc_vad_3d_all
+        """
+        sums = self._scan_sums(az, elev, vel)
+
+        if self._totals is None:
+            self._totals = dict((key, value.copy()) for key, value in sums.items())
+        elif sums['y'].shape != self._totals['y'].shape:
+            raise ValueError("Scan has {} gates but the window has {}".format(sums['y'].shape[0],
+                                                                            self._totals['y'].shape[0]))
+        else:
+            for key in self._totals:
+                self._totals[key] += sums[key]
+
+        self._scans.append((date, sums))
+
+        while self._scans and (date - self._scans[0][0]).total_seconds() >= self.window:
+            self.remove_oldest()
+
+        self._num_updates += 1
+        if self._num_updates >= RESUM_SCANS and self._scans:
+            self._resum()
+
+    def _resum(self):
+        """
+        Adds the sums for the scans in the window up again from scratch
+        """
+        scans = iter(self._scans)
+        self._totals = dict((key, value.copy()) for key, value in next(scans)[1].items())
+        for date, sums in scans:
+            for key in self._totals:
+                self._totals[key] += sums[key]
+
+        self._num_updates = 0
+
+    def remove_oldest(self):
+        """
+        Takes the oldest scan back out of the window
+        """
+        date, sums = self._scans.popleft()
+
+        if len(self._scans) == 0:
+            self._totals = None
+            return
+
+        for key in self._totals:
+            self._totals[key] -= sums[key]
+
+    def solve(self):
+        """
+        Does the VAD for everything in the window
+        :return: u, v, w, rmse, r_sq like calc_vad_3d_all
+        """
+        if self._totals is None:
+            raise ValueError("No scans in the window")
+
+        return _solve_sums(self._totals)
+
+
+def _process_worker(job):
+    """
+    Runs process_file (or another function taking the same arguments, like read_scan) for
+    one scan. Errors are caught and sent back so one bad file doesn't kill the rest of the run.
+    :param job: (function, in_file, system) tuple
+    :return: (in_file, output of the function or None, traceback or None)
+    """
+    func, in_file, system = job
+
+    try:
+        return in_file, func(in_file, system), None
+    except Exception:
+        return in_file, None, traceback.format_exc()
+
+
+class DailyVadWriter(object):
+    """
+    Appends VAD profiles to daily time-height netcdfs instead of writing one small file
+    per scan. There is one file per day and nominal elevation, named
+    {prefix}_{YYYYmmdd}_{elev}.nc, with an unlimited time dimension and a fixed height
+    dimension. Profiles that don't come from a single elevation (like combined scans) can
+    be given a tag to use in place of the elevation. Files are kept open between scans until close() is called, and a file
+    that already exists is appended to (use has_profile to skip profiles it already has).
+    """
+
+    def __init__(self, out_dir, prefix='vad', sync=False):
+        """
+        :param out_dir: Directory for the daily files
+        :param prefix: Prefix for the filenames
+        :param sync: Flush each profile to disk as soon as it is written
+        """
+        self.out_dir = out_dir
+        self.prefix = prefix
+        self.sync = sync
+        self._open = {}
+
+    def filename(self, date, elev, tag=None):
+        if tag is None:
+            tag = int(np.mean(elev))
+
+        nc_name = "{prefix}_{date}_{elev}.nc"
+        nc_name = nc_name.format(prefix=self.prefix, date=date.strftime("%Y%m%d"), elev=tag)
+        return os.path.join(self.out_dir, nc_name)
+
+    def _get_nc(self, date, elev, num_heights, tag=None):
+        filename = self.filename(date, elev, tag)
+
+        if filename not in self._open:
+            if os.path.exists(filename):
+                nc = netCDF4.Dataset(filename, 'a')
+            else:
+                nc = self._setup_nc(filename, date, elev, num_heights, tag)
+
+            self._open[filename] = nc
+
+        return self._open[filename]
+
+    def _setup_nc(self, filename, date, elev, num_heights, tag=None):
+        nc = netCDF4.Dataset(filename, 'w', format="NETCDF4")
+
+        nc.createDimension('time', None)
+        nc.createDimension('height', num_heights)
+
+        # Add the attributes
+        if tag is None:
+            nc.setncattr("elev", int(np.mean(elev)))
+        else:
+            nc.setncattr("elev", str(tag))
+        nc.setncattr("date", date.strftime("%Y-%m-%d"))
+
+        day = datetime(date.year, date.month, date.day)
+
+        var = nc.createVariable('base_time', 'i8')
+        var.setncattr('long_name', 'Time')
+        var.setncattr('units', 'seconds since 1970-01-01 00:00:00 UTC')
+        var[:] = (day - datetime(1970, 1, 1)).total_seconds()
+
+        var = nc.createVariable('time_offset', 'f8', ('time',))
+        var.setncattr('long_name', 'Time offset')
+        var.setncattr('units', 'seconds since base_time')
+
+        var = nc.createVariable('time', 'i8', ('time',))
+        var.setncattr('units', 'seconds since 1970-01-01 00:00:00 UTC')
+
+        var = nc.createVariable('elev', 'f8', ('time',), fill_value=FILL_VALUE)
+        var.setncattr('long_name', 'Mean elevation angle of the scan')
+        var.setncattr('units', 'degrees')
+
+        opts = {'zlib': True, 'chunksizes': (CHUNK_PROFILES, num_heights), 'fill_value': FILL_VALUE}
+        for name in ['u', 'v', 'w', 'hgt', 'rms', 'r_sq']:
+            nc.createVariable(name, 'f8', ('time', 'height'), **opts)
+
+        return nc
+
+    def has_profile(self, date, elev, tag=None):
+        """
+        Checks if the daily file already has a profile for this time, so a scan that gets
+        processed twice doesn't show up twice
+        """
+        filename = self.filename(date, elev, tag)
+        if filename not in self._open and not os.path.exists(filename):
+            return False
+
+        nc = self._get_nc(date, elev, None, tag)
+        epoch = (date - datetime(1970, 1, 1)).total_seconds()
+
+        # time is whole seconds, so the offset is what has the exact scan time
+        return bool(np.any(nc['time_offset'][:] == epoch - nc['base_time'][:]))
+
+    def write(self, date, elev, u, v, w, hgt, rmse, r_sq, tag=None):
+        """
+        Appends one profile from process_file to the right daily file
+        :param tag: Used in the filename in place of the elevation
+        :return: Name of the file written to
+        """
+        nc = self._get_nc(date, elev, len(hgt), tag)
+
+        if len(hgt) != len(nc.dimensions['height']):
+            raise ValueError("Profile has {} heights but {} has {}".format(len(hgt), nc.filepath(),
+                                                                         len(nc.dimensions['height'])))
+
+        i = len(nc.dimensions['time'])
+        epoch = (date - datetime(1970, 1, 1)).total_seconds()
+
+        nc['time'][i] = epoch
+        nc['time_offset'][i] = epoch - nc['base_time'][:]
+        nc['elev'][i] = np.mean(elev)
+
+        nc['u'][i] = np.where(np.isnan(u), FILL_VALUE, u)
+        nc['v'][i] = np.where(np.isnan(v), FILL_VALUE, v)
+        nc['w'][i] = np.where(np.isnan(w), FILL_VALUE, w)
+        nc['hgt'][i] = np.where(np.isnan(hgt), FILL_VALUE, hgt)
+        nc['rms'][i] = np.where(np.isnan(rmse), FILL_VALUE, rmse)
+        nc['r_sq'][i] = np.where(np.isnan(r_sq), FILL_VALUE, r_sq)
+
+        if self.sync:
+            nc.sync()
+
+        return nc.filepath()
+
+    def close(self):
+        for nc in self._open.values():
+            nc.close()
+
+        self._open = {}
+
+
 if __name__=='__main__':
     parser = argparse.ArgumentParser()
 
@@ -336,9 +945,27 @@ if __name__=='__main__':
     parser.add_argument('-O', dest='out_prefix', default='vad')
     parser.add_argument('-o', dest='out_dir', default=os.getcwd())
     parser.add_argument('-s', dest='system', default=None)
+    parser.add_argument('-d', '--daily', dest='daily', action='store_true',
+                        help='Append the profiles to daily time-height files instead of one file per scan')
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=1,
+                        help='Number of scans to process in parallel')
+    parser.add_argument('-w', '--window', dest='window', type=float, default=None,
+                        help='Average the VAD over a sliding window of this many minutes of scans')
+    parser.add_argument('-c', '--combine', dest='combine', type=float, default=None,
+                        help='Combine the scans (any elevation) in each block of this many minutes into one '
+                             'profile on a common height grid')
+    parser.add_argument('--bin-size', dest='bin_size', type=float, default=25.,
+                        help='Depth of the height bins (m) when combining scans')
+    parser.add_argument('--max-height', dest='max_height', type=float, default=None,
+                        help='Top of the height grid (m) when combining scans')
 
     args = parser.parse_args()
 
+    if args.window is not None and args.combine is not None:
+        parser.error("-w and -c can't be used together")
+    if args.window is not None and args.window <= 0:
+        parser.error("-w has to be more than 0 minutes")
+
     vad_ws = np.zeros(len(args.in_files))
     vad_wd = np.zeros(len(args.in_files))
     time = np.zeros(len(args.in_files), dtype=datetime)
@@ -346,79 +973,159 @@ if __name__=='__main__':
 
     height = 100
 
-    for i, f in enumerate(sorted(args.in_files)):
-        print f
-        u, v, w, hgt, rmse, r_sq, date, elev = process_file(f, system=args.system)#, height=height, sinfit_dir=args.out_dir)
-        nc_name = "{prefix}_{date}_{elev}.nc"
-        nc_name = nc_name.format(prefix=args.out_prefix, date=date.strftime("%Y%m%d_%H%M%S"), elev=int(np.mean(elev)))
-        nc_name = os.path.join(args.out_dir, nc_name)
-
-        write_to_nc(nc_name, date, elev, u, v, w, hgt, rmse, r_sq)
-
-
-        #
-        # ws = np.sqrt(np.asarray(u)**2 + np.asarray(v)**2)
-        # wd = np.arctan2(u, v)
-        #
-        # vad_ws[i] = ws
-        # vad_wd[i] = np.rad2deg(wd)
-        # time[i] = date
-        # vad_rmse[i] = rmse
-
-        # fig = plt.figure(1, figsize=(25, 7))
-        # fig.suptitle(date.isoformat())
-        # plt.subplot(1, 5, 1)
-        # plt.plot(u, hgt, label=date.strftime("%H:%M"))
-        # plt.title("U velocity vs Height")
-        # plt.xlabel('Velocity (m/s)')
-        # plt.ylabel('Height (m)')
-        # plt.xlim(VEL_LIM)
-        # plt.ylim(HGT_LIM)
-        # plt.legend()
-        #
-        # plt.subplot(1, 5, 2)
-        # plt.plot(v, hgt)
-        # plt.title("V velocity vs Height")
-        # plt.xlabel('Velocity (m/s)')
-        # plt.ylabel('Height (m)')
-        # plt.xlim(VEL_LIM)
-        # plt.ylim(HGT_LIM)
-        #
-        # plt.subplot(1, 5, 3)
-        # plt.plot(w, hgt)
-        # plt.title("W velocity vs Height")
-        # plt.xlabel('Velocity (m/s)')
-        # plt.ylabel('Height (m)')
-        # plt.xlim((-5, 5))
-        # plt.ylim(HGT_LIM)
-        #
-        # plt.subplot(1, 5, 4)
-        # plt.plot(rmse, hgt)
-        # plt.title("RMS vs Height")
-        # plt.xlabel('RMS')
-        # plt.ylabel('Height (m)')
-        # plt.xlim((0, 10))
-        # plt.ylim(HGT_LIM)
-        #
-        # plt.subplot(1, 5, 5)
-        # plt.plot(r_sq, hgt)
-        # plt.title("$R^2$ vs Height")
-        # plt.xlabel('$R^2$')
-        # plt.ylabel('Height (m)')
-        # plt.xlim((.8, 1))
-        # plt.ylim(HGT_LIM)
-        #
-        # # Create profile base on start time of first profile
-        # if i % PROFILES_PER_PLOT == 0:
-        #     image_name = "{prefix}_{date}.png"
-        #     image_name = image_name.format(prefix=args.out_prefix, date=date.strftime("%Y%m%d_%H%M%S"))
-        #     image_name = os.path.join(args.out_dir, image_name)
-        #
-        # if i % PROFILES_PER_PLOT == PROFILES_PER_PLOT - 1:
-        #     # Save the image
-        #     plt.savefig(image_name)
-        #     plt.clf()
-        #     plt.close()
+    if args.daily:
+        writer = DailyVadWriter(args.out_dir, prefix=args.out_prefix)
+
+    # Results come back in the same (time) order as the files, so the outputs get written in order
+    if args.window is None and args.combine is None:
+        jobs = [(process_file, f, args.system) for f in sorted(args.in_files)]
+    else:
+        jobs = [(read_scan, f, args.system) for f in sorted(args.in_files)]
+
+    # Sliding windows for -w, one per nominal elevation. Gate k of a scan at another
+    # elevation is at a different height, so the scans can't go in the same fit.
+    accumulators = {}
+
+    if args.jobs > 1:
+        pool = multiprocessing.Pool(args.jobs)
+        results = pool.imap(_process_worker, jobs)
+    else:
+        pool = None
+        results = (_process_worker(job) for job in jobs)
+
+    if args.combine is not None:
+        results = _combine_results(results, args.combine * 60., args.bin_size, max_height=args.max_height)
+
+    failed = []
+    try:
+        for i, (f, result, error) in enumerate(results):
+            print f
+            if error is not None:
+                print "Failed to process {}\n{}".format(f, error)
+                failed.append(f)
+                continue
+
+            try:
+                if args.window is None:
+                    u, v, w, hgt, rmse, r_sq, date, elev = result  # process_file(f, system=args.system, height=height, sinfit_dir=args.out_dir)
+                else:
+                    # Profile for the window ending with this scan
+                    date, rng, az, elev, vel = result
+                    elev_key = int(np.mean(elev))
+                    if elev_key not in accumulators:
+                        accumulators[elev_key] = VadAccumulator(args.window * 60.)
+
+                    accumulator = accumulators[elev_key]
+                    try:
+                        accumulator.add(date, _beam_angles(az), _beam_angles(elev), vel)
+                    except ValueError:
+                        # Scan setup changed, so start the window over
+                        print "Gate count changed at {}, starting a new window".format(f)
+                        accumulator = accumulators[elev_key] = VadAccumulator(args.window * 60.)
+                        accumulator.add(date, _beam_angles(az), _beam_angles(elev), vel)
+                    u, v, w, rmse, r_sq = accumulator.solve()
+                    hgt = beam_geometry.profile_height(rng, _beam_angles(elev))
+                    elev = elev[:, -1]
+
+                # Combined profiles are from a mix of elevations, so they're named for that instead
+                tag = 'combined' if args.combine is not None else None
+
+                if args.daily:
+                    # Rerunning over scans that are already in the day's file doesn't add them again
+                    if writer.has_profile(date, elev, tag=tag):
+                        print "Profile for {} is already in {}".format(f, writer.filename(date, elev, tag))
+                    else:
+                        writer.write(date, elev, u, v, w, hgt, rmse, r_sq, tag=tag)
+                    continue
+
+                nc_name = "{prefix}_{date}_{elev}.nc"
+                nc_name = nc_name.format(prefix=args.out_prefix, date=date.strftime("%Y%m%d_%H%M%S"),
+                                         elev=int(np.mean(elev)) if tag is None else tag)
+                nc_name = os.path.join(args.out_dir, nc_name)
+
+                write_to_nc(nc_name, date, elev, u, v, w, hgt, rmse, r_sq)
+            except Exception:
+                # Don't let one bad scan stop the rest
+                print "Failed to write the profile for {}\n{}".format(f, traceback.format_exc())
+                failed.append(f)
+
+
+            #
+            # ws = np.sqrt(np.asarray(u)**2 + np.asarray(v)**2)
+            # wd = np.arctan2(u, v)
+            #
+            # vad_ws[i] = ws
+            # vad_wd[i] = np.rad2deg(wd)
+            # time[i] = date
+            # vad_rmse[i] = rmse
+
+            # fig = plt.figure(1, figsize=(25, 7))
+            # fig.suptitle(date.isoformat())
+            # plt.subplot(1, 5, 1)
+            # plt.plot(u, hgt, label=date.strftime("%H:%M"))
+            # plt.title("U velocity vs Height")
+            # plt.xlabel('Velocity (m/s)')
+            # plt.ylabel('Height (m)')
+            # plt.xlim(VEL_LIM)
+            # plt.ylim(HGT_LIM)
+            # plt.legend()
+            #
+            # plt.subplot(1, 5, 2)
+            # plt.plot(v, hgt)
+            # plt.title("V velocity vs Height")
+            # plt.xlabel('Velocity (m/s)')
+            # plt.ylabel('Height (m)')
+            # plt.xlim(VEL_LIM)
+            # plt.ylim(HGT_LIM)
+            #
+            # plt.subplot(1, 5, 3)
+            # plt.plot(w, hgt)
+            # plt.title("W velocity vs Height")
+            # plt.xlabel('Velocity (m/s)')
+            # plt.ylabel('Height (m)')
+            # plt.xlim((-5, 5))
+            # plt.ylim(HGT_LIM)
+            #
+            # plt.subplot(1, 5, 4)
+            # plt.plot(rmse, hgt)
+            # plt.title("RMS vs Height")
+            # plt.xlabel('RMS')
+            # plt.ylabel('Height (m)')
+            # plt.xlim((0, 10))
+            # plt.ylim(HGT_LIM)
+            #
+            # plt.subplot(1, 5, 5)
+            # plt.plot(r_sq, hgt)
+            # plt.title("$R^2$ vs Height")
+            # plt.xlabel('$R^2$')
+            # plt.ylabel('Height (m)')
+            # plt.xlim((.8, 1))
+            # plt.ylim(HGT_LIM)
+            #
+            # # Create profile base on start time of first profile
+            # if i % PROFILES_PER_PLOT == 0:
+            #     image_name = "{prefix}_{date}.png"
+            #     image_name = image_name.format(prefix=args.out_prefix, date=date.strftime("%Y%m%d_%H%M%S"))
+            #     image_name = os.path.join(args.out_dir, image_name)
+            #
+            # if i % PROFILES_PER_PLOT == PROFILES_PER_PLOT - 1:
+            #     # Save the image
+            #     plt.savefig(image_name)
+            #     plt.clf()
+            #     plt.close()
+
+        if pool is not None:
+            pool.close()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+        if args.daily:
+            writer.close()
+
+    if failed:
+        print "{} of {} files failed: {}".format(len(failed), len(jobs), ", ".join(failed))
 
     # fig, (ax1, ax2) = plt.subplots(2, sharex=True)
     # ind = np.logical_and(~np.isnan(vad_wd), time != 0)
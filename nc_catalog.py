@@ -0,0 +1,182 @@
+"""
+Catalog of the netcdf files in a data directory. Keeps each file's variables and the
+time span it covers in a small SQLite file, so finding the files for a time window
+doesn't mean opening every file in the directory. Updating only opens files that are
+new or have changed since the last update.
+
+Usage:
+    catalog = Catalog('/data/vad/.nc_catalog.sqlite')
+    catalog.update('/data/vad')
+    files = catalog.files(start, end, '/data/vad')
+"""
+
+import argparse
+import calendar
+import fnmatch
+import os
+import sqlite3
+
+from datetime import datetime
+from glob import glob
+
+import netCDF4
+import numpy as np
+
+CATALOG_NAME = '.nc_catalog.sqlite'
+
+
+def to_epoch(dt):
+    return calendar.timegm(dt.utctimetuple()) + dt.microsecond / 1e6
+
+
+def file_times(nc):
+    """
+    Gets the times in a netcdf file as seconds since 1970. Uses base_time + time_offset
+    if the file has them, then epoch_time, then a time variable with units netCDF4 can
+    convert.
+    :param nc: Netcdf object
+    :return: Array of epoch times, or None if the file doesn't have a time axis
+    """
+    if 'base_time' in nc.variables and 'time_offset' in nc.variables:
+        times = float(nc.variables['base_time'][...]) + np.ma.filled(nc.variables['time_offset'][:], np.nan)
+    elif 'epoch_time' in nc.variables:
+        times = np.ma.filled(nc.variables['epoch_time'][:].astype(float), np.nan)
+    elif 'time' in nc.variables and hasattr(nc.variables['time'], 'units'):
+        time = nc.variables['time']
+        epoch = netCDF4.date2num(datetime(1970, 1, 1), time.units)
+        scale = netCDF4.date2num(datetime(1970, 1, 2), time.units) - epoch
+        times = (np.ma.filled(time[:].astype(float), np.nan) - epoch) * 86400. / scale
+    else:
+        return None
+
+    # Scalar time variables (a file with a single profile) come back 0-d
+    return np.atleast_1d(times)
+
+
+class Catalog(object):
+    """
+    SQLite backed catalog of netcdf files and the times they cover
+    """
+
+    def __init__(self, db_file):
+        """
+        :param db_file: SQLite file to keep the catalog in. Created if it doesn't exist.
+        """
+        self.db_file = db_file
+        self._db = sqlite3.connect(db_file)
+        self._db.execute("CREATE TABLE IF NOT EXISTS files ("
+                         "path TEXT PRIMARY KEY, directory TEXT, size INTEGER, mtime REAL, "
+                         "start_time REAL, end_time REAL, variables TEXT)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS files_time ON files (directory, start_time, end_time)")
+        self._db.commit()
+
+    def update(self, directory, pattern='*'):
+        """
+        Brings the catalog up to date with the files in a directory. Only new and changed
+        files are opened, and files that have gone away are dropped.
+        :param directory: Directory to catalog
+        :param pattern: Glob for the files to include
+        :return: Number of files that were (re)read
+        """
+        directory = os.path.abspath(directory)
+        known = dict((row[0], (row[1], row[2])) for row in self._db.execute(
+            "SELECT path, size, mtime FROM files WHERE directory = ?", (directory,)))
+
+        db_file = os.path.abspath(self.db_file)
+        num_read = 0
+        for path in glob(os.path.join(directory, pattern)):
+            if path == db_file or fnmatch.fnmatch(os.path.basename(path), os.path.basename(db_file) + '-*'):
+                continue
+
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+
+            if known.pop(path, None) == (stat.st_size, stat.st_mtime):
+                continue
+
+            # Files that aren't netcdf (or have no times) are still kept so they aren't
+            # reopened every update, they just never match a time window
+            start_time = end_time = None
+            variables = ''
+            try:
+                nc = netCDF4.Dataset(path, 'r')
+                try:
+                    variables = ','.join(nc.variables.keys())
+                    times = file_times(nc)
+                    if times is not None and np.any(np.isfinite(times)):
+                        start_time, end_time = float(np.nanmin(times)), float(np.nanmax(times))
+                finally:
+                    nc.close()
+            except (IOError, RuntimeError, ValueError) as e:
+                print "Could not read {} for the catalog: {}".format(path, e)
+
+            self._db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)",
+                             (path, directory, stat.st_size, stat.st_mtime, start_time, end_time, variables))
+            num_read += 1
+
+        # Anything left over isn't there anymore
+        self._db.executemany("DELETE FROM files WHERE path = ?", [(path,) for path in known])
+        self._db.commit()
+
+        return num_read
+
+    def files(self, start, end, directory=None, pattern=None):
+        """
+        Gets the files with data between start and end
+        :param start: Start datetime object
+        :param end: End datetime object
+        :param directory: Only return files from this directory
+        :param pattern: Only return files with names matching this glob
+        :return: List of filenames ordered by their first time
+        """
+        query = "SELECT path FROM files WHERE start_time <= ? AND end_time >= ?"
+        params = [to_epoch(end), to_epoch(start)]
+
+        if directory is not None:
+            query += " AND directory = ?"
+            params.append(os.path.abspath(directory))
+
+        files = [row[0] for row in self._db.execute(query + " ORDER BY start_time, path", params)]
+
+        if pattern is not None:
+            files = [f for f in files if fnmatch.fnmatch(os.path.basename(f), pattern)]
+
+        return files
+
+    def info(self, path):
+        """
+        Gets what the catalog knows about a file
+        :param path: Filename
+        :return: Dictionary with the size, mtime, start and end times (as datetimes) and
+                 variables, or None if the file isn't in the catalog
+        """
+        row = self._db.execute("SELECT size, mtime, start_time, end_time, variables FROM files WHERE path = ?",
+                               (os.path.abspath(path),)).fetchone()
+        if row is None:
+            return None
+
+        size, mtime, start_time, end_time, variables = row
+        return {'size': size,
+                'mtime': mtime,
+                'start': None if start_time is None else datetime.utcfromtimestamp(start_time),
+                'end': None if end_time is None else datetime.utcfromtimestamp(end_time),
+                'variables': variables.split(',') if variables else []}
+
+    def close(self):
+        self._db.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', dest='dir', required=True, help='Directory to catalog')
+    parser.add_argument('-c', dest='catalog', default=None,
+                        help='Catalog file (default: {} in the directory)'.format(CATALOG_NAME))
+    parser.add_argument('--pattern', dest='pattern', default='*', help='Glob for the files to include')
+    args = parser.parse_args()
+
+    catalog = Catalog(args.catalog or os.path.join(args.dir, CATALOG_NAME))
+    num_read = catalog.update(args.dir, pattern=args.pattern)
+    print "Read {} new or changed files".format(num_read)
+    catalog.close()
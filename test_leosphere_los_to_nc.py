@@ -0,0 +1,80 @@
+"""
+Tests for the data line parsing in leosphere_los_to_nc
+
+Usage:
+    python -m unittest test_leosphere_los_to_nc
+"""
+
+import unittest
+
+import numpy as np
+
+from leosphere_los_to_nc import MISSING_DATA_VALUE, parse_lines
+
+NUM_RANGES = 3
+
+
+def _line(timestamp='2017/06/01  00:00:01.50', azimuth='90.00', elevation='70.00', gates=None):
+    """
+    Makes a data line. Each gate is (radial wind, dispersion, cnr) followed by 5 columns
+    that aren't used.
+    """
+    if gates is None:
+        gates = [('1.976', '0.5', '-20.1'), ('-2.108', '0.6', '-21.2'), ('4.243', '0.7', '-22.3')]
+
+    col = [timestamp, '0.1', '0.2', '0.3', '0.4', '0.5', azimuth, elevation]
+    for gate in gates:
+        col += list(gate) + ['0'] * 5
+
+    return '\t'.join(col)
+
+
+class ParseLinesTest(unittest.TestCase):
+
+    def test_good_lines(self):
+        rays = parse_lines([_line(), _line(timestamp='2017/06/01  00:00:02.00',
+                                           gates=[('NaN', '0.5', '-20.1')] * NUM_RANGES)], NUM_RANGES)
+
+        np.testing.assert_array_equal(rays['time'], [1496275201, 1496275202])
+        np.testing.assert_array_equal(rays['azimuth'], 90. * np.ones((2, NUM_RANGES)))
+        np.testing.assert_array_equal(rays['elevation'], 70. * np.ones((2, NUM_RANGES)))
+        np.testing.assert_array_equal(rays['radial_wind'], [[1.976, -2.108, 4.243], [MISSING_DATA_VALUE] * 3])
+        np.testing.assert_array_equal(rays['cnr'][0], [-20.1, -21.2, -22.3])
+
+    def test_non_numeric_gate(self):
+        # Everything before the bad value is kept, like the old line by line parsing did
+        gates = [('1.976', '0.5', '-20.1'), ('-2.108', 'x0.6', '-21.2'), ('4.243', '0.7', '-22.3')]
+        rays = parse_lines([_line(), _line(gates=gates)], NUM_RANGES)
+
+        np.testing.assert_array_equal(rays['time'], [1496275201] * 2)
+        np.testing.assert_array_equal(rays['azimuth'][1], [90.] * NUM_RANGES)
+        np.testing.assert_array_equal(rays['elevation'][1], [70.] * NUM_RANGES)
+        np.testing.assert_array_equal(rays['radial_wind'][1], [1.976, -2.108, 4.243])
+        np.testing.assert_array_equal(rays['dispersion'][1], [0.5, 0., 0.])
+        np.testing.assert_array_equal(rays['cnr'][1], [0.] * NUM_RANGES)
+        np.testing.assert_array_equal(rays['radial_wind'][0], [1.976, -2.108, 4.243])
+
+    def test_non_numeric_elevation(self):
+        rays = parse_lines([_line(elevation='?')], NUM_RANGES)
+
+        np.testing.assert_array_equal(rays['azimuth'][0], [90.] * NUM_RANGES)
+        np.testing.assert_array_equal(rays['elevation'][0], [0.] * NUM_RANGES)
+        np.testing.assert_array_equal(rays['radial_wind'][0], [0.] * NUM_RANGES)
+
+    def test_bad_timestamp(self):
+        rays = parse_lines([_line(timestamp='2017/06/01  xx:00:01.50'), _line()], NUM_RANGES)
+
+        np.testing.assert_array_equal(rays['time'], [0, 1496275201])
+        np.testing.assert_array_equal(rays['azimuth'][0], [0.] * NUM_RANGES)
+        np.testing.assert_array_equal(rays['radial_wind'][0], [0.] * NUM_RANGES)
+        np.testing.assert_array_equal(rays['radial_wind'][1], [1.976, -2.108, 4.243])
+
+    def test_short_line(self):
+        rays = parse_lines([_line(gates=[('1.976', '0.5', '-20.1'), ('-2.108', '0.6', '-21.2')])], NUM_RANGES)
+
+        np.testing.assert_array_equal(rays['azimuth'][0], [90.] * NUM_RANGES)
+        np.testing.assert_array_equal(rays['radial_wind'][0], [0.] * NUM_RANGES)
+
+
+if __name__ == '__main__':
+    unittest.main()
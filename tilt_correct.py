@@ -4,6 +4,7 @@ import os
 import netCDF4
 import numpy as np
 
+import beam_geometry
 from utils import concat_files
 from datetime import datetime
 from numpy import sin, cos
@@ -17,6 +18,67 @@ def find_nearest(value, array):
     return np.abs((array - value)).argmin(axis=0)
 
 
+# Number of rays corrected at once. Keeps the memory down for long days of stares.
+BLOCK_RAYS = 4096
+
+
+def _per_ray(angle):
+    """
+    Compact halo files only store the angles once per ray. This makes them a column so
+    they broadcast against the (time, range) arrays, leaving the full layout as is.
+    """
+    if angle.ndim == 1:
+        return angle[:, np.newaxis]
+
+    return angle
+
+
+def nearest_times(times, ref_times):
+    """
+    Finds the closest of ref_times to each of times. Same as find_nearest on each time,
+    but done in blocks of times.
+    :param times: Times to match [s]
+    :param ref_times: Times to match them to [s]
+    :return: Index into ref_times for each time
+    """
+    times = np.asarray(times, dtype=float)
+    ref_times = np.asarray(ref_times, dtype=float)
+
+    ind = np.empty(times.size, dtype=int)
+    for start in range(0, times.size, BLOCK_RAYS):
+        block = slice(start, start + BLOCK_RAYS)
+        ind[block] = np.abs(ref_times[np.newaxis, :] - times[block, np.newaxis]).argmin(axis=1)
+
+    return ind
+
+
+def nearest_gates(vert_hgt, horiz_hgt, time_ind):
+    """
+    Finds the closest profile height to each stare gate. Same as find_nearest on each ray,
+    but only done once for each profile and beam.
+    :param vert_hgt: (ntime, nrange) array of stare gate heights
+    :param horiz_hgt: (nprofile, nheight) array of profile heights
+    :param time_ind: Index of the profile matched to each ray
+    :return: (ntime, nrange) array of indices into the profile heights
+    """
+    gate_ind = np.empty(vert_hgt.shape, dtype=int)
+    profile_ind = np.minimum(time_ind, horiz_hgt.shape[0] - 1)
+
+    for t in np.unique(profile_ind):
+        rays = np.flatnonzero(profile_ind == t)
+
+        # Nearly every ray has the same elevation, so only do each beam once. Rows are
+        # compared as raw bytes since np.unique only works on rows from numpy 1.13.
+        hgt = np.ascontiguousarray(vert_hgt[rays])
+        rows = hgt.view(np.dtype((np.void, hgt.dtype.itemsize * hgt.shape[1]))).ravel()
+        _, first, beam_ind = np.unique(rows, return_index=True, return_inverse=True)
+        beams = hgt[first]
+        nearest = np.abs(horiz_hgt[t][np.newaxis, :, np.newaxis] - beams[:, np.newaxis, :]).argmin(axis=1)
+        gate_ind[rays] = nearest[beam_ind]
+
+    return gate_ind
+
+
 def rotate(u, v, w, yaw, pitch, roll):
 
     rot_matrix = np.asarray(
@@ -31,34 +93,75 @@ def rotate(u, v, w, yaw, pitch, roll):
     return result[0, 0], result[0, 1], result[0, 2]
 
 
-def process_files(vert_files, horiz_files, out_dir, prefix):
+def rotate_all(u, v, w, yaw, pitch, roll):
+    """
+    Batched version of rotate. The rotation terms are worked out once for each set of
+    angles and broadcast against the velocities, so angles given per ray (as (ntime, 1)
+    columns) apply to every gate of the ray. Gives the same numbers as rotate.
+    :param u, v, w: Velocity components
+    :param yaw, pitch, roll: Angles [rad]
+    :return: Rotated u, v, w
+    """
+    sin_yaw, cos_yaw = sin(yaw), cos(yaw)
+    sin_pitch, cos_pitch = sin(pitch), cos(pitch)
+    sin_roll, cos_roll = sin(roll), cos(roll)
+
+    rot_u = u * (cos_yaw*cos_pitch) + v * (sin_yaw*cos_pitch) + w * -sin_pitch
+    rot_v = (u * (cos_yaw*sin_pitch*sin_roll-sin_yaw*cos_roll) + v * (sin_yaw*sin_pitch*sin_roll+cos_yaw*cos_roll)
+             + w * (cos_pitch*sin_roll))
+    rot_w = (u * (cos_yaw*sin_pitch*cos_roll+sin_yaw*sin_roll) + v * (sin_yaw*sin_pitch*cos_roll-cos_yaw*sin_roll)
+             + w * (cos_pitch*cos_roll))
+
+    return rot_u, rot_v, rot_w
+
+
+def process_files(vert_files, horiz_files, out_dir, prefix, match_heights=False):
+    """
+    Corrects vertical stares for the tilt of the lidar using the horizontal winds
+    :param vert_files: Stare netcdfs
+    :param horiz_files: Wind profile netcdfs
+    :param out_dir: Directory for the corrected netcdf
+    :param prefix: Prefix for the corrected netcdf's name
+    :param match_heights: Use the profile winds at the height closest to each stare gate.
+                          Needs an 'hgt' variable in the profiles. Otherwise profile gate k
+                          is used for stare gate k.
+    """
 
     # Get all the data
     vert_data = concat_files(vert_files)
     horiz_data = concat_files(horiz_files)
 
+    # Match each stare to the closest wind profile
+    time_ind = nearest_times(vert_data['epoch'], horiz_data['time'])
+
     # Convert the datetime64 things to python datetime objects and put them back in the dictionary
-    vert_times = np.asarray([datetime.utcfromtimestamp(vert_data['epoch'][i])
-                             for i in range(vert_data['epoch'].size)])
-    horiz_times = np.asarray([datetime.utcfromtimestamp(horiz_data['time'][i])
-                             for i in range(horiz_data['time'].size)])
+    vert_data['time'] = np.asarray([datetime.utcfromtimestamp(vert_data['epoch'][i])
+                                    for i in range(vert_data['epoch'].size)])
 
-    vert_data['time'] = vert_times
-    horiz_data['time'] = horiz_times
+    # Either match the heights of the stare gates to the wind profiles, or assume they are
+    # the same gate ranges
+    if match_heights:
+        if 'hgt' not in horiz_data:
+            raise ValueError("Matching heights needs the profile heights ('hgt')")
 
-    del vert_times, horiz_times
+        vert_hgt = beam_geometry.lookup(vert_data['range'], vert_data['elevation'])[0]
+        gate_ind = nearest_gates(vert_hgt, np.atleast_2d(horiz_data['hgt']), time_ind)
+    else:
+        gate_ind = np.arange(vert_data['range'].size)[np.newaxis, :]
 
-    # Go through each vertical stare and correct it
-    new_data = np.zeros_like(vert_data['velocity'])
-    for i in range(vert_data['time'].size):
-        time_ind = find_nearest(vert_data['time'][i], horiz_data['time'])
+    # Correct the stares a block of rays at a time
+    pitch = _per_ray(vert_data['pitch'])
+    roll = _per_ray(vert_data['roll'])
 
-        # TODO - Match Heights. Right now assume they are the same gate ranges
+    new_data = np.zeros_like(vert_data['velocity'])
+    for start in range(0, new_data.shape[0], BLOCK_RAYS):
+        rays = slice(start, start + BLOCK_RAYS)
+        profile = time_ind[rays, np.newaxis]
+        gates = gate_ind[rays] if match_heights else gate_ind
 
-        for j, h in enumerate(vert_data['range']):
-            u, v, w = rotate(horiz_data['u'][time_ind, j], horiz_data['v'][time_ind, j], vert_data['velocity'][i, j],
-                   0, -np.deg2rad(vert_data['pitch'][i, j]), -np.deg2rad(vert_data['roll'][i, j]))
-            new_data[i, j] = w
+        u, v, w = rotate_all(horiz_data['u'][profile, gates], horiz_data['v'][profile, gates],
+                             vert_data['velocity'][rays], 0, -np.deg2rad(pitch[rays]), -np.deg2rad(roll[rays]))
+        new_data[rays] = w
 
     # Write out the corrected data to netcdf along with the original stuff
     if not os.path.exists(out_dir):
@@ -99,22 +202,28 @@ def process_files(vert_files, horiz_files, out_dir, prefix):
     var.setncattr('units', 'km AGL')
     var[:] = vert_data['range']
 
-    var = nc.createVariable('azimuth', 'f8', dimensions=('time', 'range'))
+    # Keep the angles in the same layout as the input files
+    if vert_data['azimuth'].ndim == 1:
+        angle_dims = ('time',)
+    else:
+        angle_dims = ('time', 'range')
+
+    var = nc.createVariable('azimuth', 'f8', dimensions=angle_dims)
     var.setncattr('long_name', 'Azimuth Angle')
     var.setncattr('units', 'degrees')
     var[:] = vert_data['azimuth']
 
-    var = nc.createVariable('elevation', 'f8', dimensions=('time', 'range'))
+    var = nc.createVariable('elevation', 'f8', dimensions=angle_dims)
     var.setncattr('long_name', 'Elevation angle')
     var.setncattr('units', 'degrees above the horizon')
     var[:] = vert_data['elevation']
 
-    var = nc.createVariable('pitch', 'f8', dimensions=('time', 'range'))
+    var = nc.createVariable('pitch', 'f8', dimensions=angle_dims)
     var.setncattr('long_name', 'Instrument Pitch')
     var.setncattr('units', 'degrees')
     var[:] = vert_data['pitch']
 
-    var = nc.createVariable('roll', 'f8', dimensions=('time', 'range'))
+    var = nc.createVariable('roll', 'f8', dimensions=angle_dims)
     var.setncattr('long_name', 'Instrument Roll')
     var.setncattr('units', 'degrees')
     var[:] = vert_data['roll']
@@ -145,8 +254,10 @@ if __name__ == "__main__":
     parser.add_argument('-i', action='store', dest='horiz_files', nargs='*')
     parser.add_argument('-o', action='store', dest='out_dir')
     parser.add_argument('-p', action='store', dest='prefix')
+    parser.add_argument('--match-heights', action='store_true', dest='match_heights',
+                        help='Use the profile winds closest in height to each stare gate instead of the same gate')
     args = parser.parse_args()
 
-    process_files(args.vert_files, args.horiz_files, args.out_dir, args.prefix)
+    process_files(args.vert_files, args.horiz_files, args.out_dir, args.prefix, match_heights=args.match_heights)
 
     pass
\ No newline at end of file
@@ -0,0 +1,222 @@
+"""
+Benchmarks the VAD retrieval on synthetic PPI scans. The scans are made from a known
+wind profile in any of the layouts in lidar_to_vad.var_lookup, so the speed and the
+retrieval error can be checked without campaign files.
+
+Times the full process_file -> write_to_nc path and the solver on its own, and checks
+the batched solver against the original one gate at a time calc_vad_3d.
+
+Usage:
+    python vad_benchmark.py -s mp1 -n 10 -a 24 -g 200 --noise 0.3 --masked 0.1
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from datetime import datetime, timedelta
+
+import netCDF4
+import numpy as np
+
+from numpy import sin, cos
+
+import beam_geometry
+import lidar_to_vad
+from lidar_to_vad import FILL_VALUE, var_lookup
+
+
+def wind_profile(hgt):
+    """
+    Default wind profile for the synthetic scans. Veering and increasing with height.
+    :param hgt: Heights [m]
+    :return: u, v, w [m/s]
+    """
+    u = 5. + hgt / 200.
+    v = -3. + hgt / 500.
+    w = .2 * np.sin(hgt / 300.)
+
+    return u, v, w
+
+
+def make_scan(filename, system='mp1', date=None, num_az=24, num_gates=100, gate_length=30., elev=70.,
+              noise=.3, masked=.1, profile=wind_profile, seed=None):
+    """
+    Writes a synthetic PPI in the layout for system
+    :param filename: File to write
+    :param system: Key in var_lookup to get the variable names and threshold from
+    :param date: Start time of the scan
+    :param num_az: Number of beams (evenly spaced in azimuth)
+    :param num_gates: Number of range gates
+    :param gate_length: Length of each gate [m]
+    :param elev: Elevation angle [deg]
+    :param noise: Standard deviation of the noise added to the radial velocity [m/s]
+    :param masked: Fraction of the gates to put below the threshold
+    :param profile: Function giving u, v, w from height
+    :param seed: Random seed
+    :return: (nrange,) arrays of the true u, v, w at each gate
+    """
+    lookup = var_lookup[system]
+    rs = np.random.RandomState(seed)
+
+    if date is None:
+        date = datetime(2017, 6, 1)
+
+    rng = (np.arange(num_gates) + .5) * gate_length
+    az = np.arange(num_az) * 360. / num_az
+    el = np.full(num_az, elev)
+
+    hgt = beam_geometry.profile_height(rng, el)
+    u, v, w = profile(hgt)
+
+    az_rad = np.deg2rad(az)[:, np.newaxis]
+    el_rad = np.deg2rad(el)[:, np.newaxis]
+    vel = sin(az_rad) * cos(el_rad) * u + cos(az_rad) * cos(el_rad) * v + sin(el_rad) * w
+    vel += rs.normal(0, noise, vel.shape)
+
+    thresh = np.where(rs.uniform(size=vel.shape) < masked, lookup['thresh_value'] - 1., lookup['thresh_value'] + 1.)
+
+    nc = netCDF4.Dataset(filename, 'w')
+    nc.setncattr('start_time', date.strftime("%Y-%m-%dT%H:%M:%S"))
+
+    nc.createDimension('time', size=None)
+    nc.createDimension('range', size=num_gates)
+
+    var = nc.createVariable(lookup['range'], 'f8', dimensions=('range',))
+    var[:] = rng
+
+    for name, data in [(lookup['az'], az[:, np.newaxis]), (lookup['elev'], el[:, np.newaxis]),
+                       (lookup['vel'], vel), (lookup['thresh_var'], thresh)]:
+        var = nc.createVariable(name, 'f8', dimensions=('time', 'range'), fill_value=FILL_VALUE)
+        var[:] = np.broadcast_to(data, vel.shape)
+
+    nc.close()
+
+    return u, v, w
+
+
+def reference_solver(az, elev, vel):
+    """
+    The original solver, calc_vad_3d one gate at a time on the good beams
+    :param az, elev, vel: (nbeams, nrange) arrays, vel is masked where the data is bad
+    :return: u, v, w arrays
+    """
+    num_gates = vel.shape[1]
+    u = np.full(num_gates, np.nan)
+    v = np.full(num_gates, np.nan)
+    w = np.full(num_gates, np.nan)
+
+    for i in range(num_gates):
+        good = ~np.ma.getmaskarray(vel[:, i])
+        sol = lidar_to_vad.calc_vad_3d(az[good, i], elev[good, i], np.asarray(vel[good, i]))
+        if sol[0] != FILL_VALUE:
+            u[i], v[i], w[i] = sol
+
+    return u, v, w
+
+
+def _rms_error(retrieved, truth):
+    return np.sqrt(np.nanmean((np.asarray(retrieved) - truth) ** 2))
+
+
+def run(system='mp1', num_scans=10, repeat=3, reference=True, out_dir=None, **scan_kwargs):
+    """
+    Makes the synthetic scans and runs the benchmarks
+    :param system: Layout to use
+    :param num_scans: Number of scans to make
+    :param repeat: Number of times to repeat the solver timing (best is reported)
+    :param reference: Also time the original solver and compare against it
+    :param out_dir: Where to put the scans and VAD files. A temporary directory is used (and
+                    removed) if not given.
+    :param scan_kwargs: Passed to make_scan
+    """
+    keep = out_dir is not None
+    if out_dir is None:
+        out_dir = tempfile.mkdtemp(prefix='vad_benchmark_')
+    elif not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    try:
+        # Make the scans
+        files = []
+        truth = []
+        for i in range(num_scans):
+            date = datetime(2017, 6, 1) + timedelta(minutes=5 * i)
+            filename = os.path.join(out_dir, date.strftime("synthetic_ppi_%Y%m%d_%H%M%S.nc"))
+            truth.append(make_scan(filename, system=system, date=date, seed=i, **scan_kwargs))
+            files.append(filename)
+
+        scans = [lidar_to_vad.read_scan(f, system) for f in files]
+        num_gates = sum(scan[-1].size for scan in scans)
+
+        print "{} scans of {} beams x {} gates ({} layout)".format(num_scans, scans[0][-1].shape[0],
+                                                                   scans[0][-1].shape[1], system)
+
+        # Full path, reading through writing
+        start = time.time()
+        results = []
+        for f in files:
+            u, v, w, hgt, rmse, r_sq, date, elev = lidar_to_vad.process_file(f, system)
+            nc_name = os.path.join(out_dir, date.strftime("vad_%Y%m%d_%H%M%S.nc"))
+            lidar_to_vad.write_to_nc(nc_name, date, elev, u, v, w, hgt, rmse, r_sq)
+            results.append((u, v, w))
+        elapsed = time.time() - start
+
+        print "process_file -> write_to_nc: {:.3f} s ({:.0f} gates/s)".format(elapsed, num_gates / elapsed)
+
+        # Solver on its own
+        best = np.inf
+        for i in range(repeat):
+            start = time.time()
+            for date, rng, az, elev, vel in scans:
+                lidar_to_vad.calc_vad_3d_all(lidar_to_vad._beam_angles(az), lidar_to_vad._beam_angles(elev), vel)
+            best = min(best, time.time() - start)
+
+        print "calc_vad_3d_all: {:.4f} s ({:.0f} gates/s)".format(best, num_gates / best)
+
+        # Retrieval error against the profile the scans were made from
+        for name, ind in [('u', 0), ('v', 1), ('w', 2)]:
+            error = np.mean([_rms_error(result[ind], t[ind]) for result, t in zip(results, truth)])
+            print "RMS error in {}: {:.4f} m/s".format(name, error)
+
+        if reference:
+            start = time.time()
+            max_diff = 0.
+            for (date, rng, az, elev, vel), result in zip(scans, results):
+                az = np.broadcast_to(az, vel.shape)
+                elev = np.broadcast_to(elev, vel.shape)
+                ref = reference_solver(az, elev, vel)
+                max_diff = max([max_diff] + [np.nanmax(np.abs(np.asarray(a) - b)) for a, b in zip(result, ref)])
+            elapsed = time.time() - start
+
+            print "calc_vad_3d (per gate): {:.4f} s ({:.0f} gates/s)".format(elapsed, num_gates / elapsed)
+            print "Max difference from calc_vad_3d: {:.3g} m/s".format(max_diff)
+
+    finally:
+        if not keep:
+            shutil.rmtree(out_dir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', dest='system', default='mp1', choices=sorted(var_lookup.keys()))
+    parser.add_argument('-n', dest='num_scans', type=int, default=10, help='Number of scans')
+    parser.add_argument('-a', dest='num_az', type=int, default=24, help='Number of beams per scan')
+    parser.add_argument('-g', dest='num_gates', type=int, default=100, help='Number of range gates')
+    parser.add_argument('-e', dest='elev', type=float, default=70., help='Elevation angle')
+    parser.add_argument('--noise', dest='noise', type=float, default=.3,
+                        help='Standard deviation of the radial velocity noise (m/s)')
+    parser.add_argument('--masked', dest='masked', type=float, default=.1,
+                        help='Fraction of gates below the threshold')
+    parser.add_argument('-r', dest='repeat', type=int, default=3, help='Number of times to repeat the solver timing')
+    parser.add_argument('--no-reference', dest='reference', action='store_false',
+                        help="Don't time or compare against the original calc_vad_3d")
+    parser.add_argument('-o', dest='out_dir', default=None, help='Keep the synthetic files in this directory')
+
+    args = parser.parse_args()
+
+    run(system=args.system, num_scans=args.num_scans, repeat=args.repeat, reference=args.reference,
+        out_dir=args.out_dir, num_az=args.num_az, num_gates=args.num_gates, elev=args.elev,
+        noise=args.noise, masked=args.masked)
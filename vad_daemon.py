@@ -0,0 +1,273 @@
+"""
+Long running VAD service. Watches a directory of decoded PPIs and runs
+lidar_to_vad.process_file on each new one as it lands, appending the profile to the
+daily time-height file. Uses inotify (through pyinotify) when it's installed and polls
+the directory otherwise.
+
+The files that have been done are kept in a state file in the output directory, so
+restarting the service (or running it alongside the cron jobs) doesn't process
+anything twice. Files that fail are tried again after a while, up to MAX_TRIES times,
+before they are given up on.
+
+Usage:
+    python vad_daemon.py -i /data/ppi -o /data/vad -s mp1
+"""
+
+import argparse
+import fnmatch
+import logging
+import os
+import signal
+import sys
+import time
+
+from glob import glob
+
+import lidar_to_vad
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+# Number of times to try a file before giving up on it
+MAX_TRIES = 3
+
+
+class ProcessedSet(object):
+    """
+    Set of the files that have already been processed, backed by a text file with one
+    path per line. Each path is written out as soon as it is added.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._paths = set()
+
+        if os.path.exists(filename):
+            with open(filename) as f:
+                self._paths = set(line.rstrip('\n') for line in f if line.strip())
+
+    def __contains__(self, path):
+        return os.path.abspath(path) in self._paths
+
+    def __len__(self):
+        return len(self._paths)
+
+    def add(self, path):
+        path = os.path.abspath(path)
+        if path in self._paths:
+            return
+
+        with open(self.filename, 'a') as f:
+            f.write(path + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+        self._paths.add(path)
+
+
+def _is_settled(path, settle_time):
+    """
+    Checks that a file hasn't been modified in settle_time seconds, so files that are
+    still being written get left alone when polling
+    """
+    try:
+        return time.time() - os.path.getmtime(path) >= settle_time
+    except OSError:
+        return False
+
+
+class VadDaemon(object):
+    """
+    Watches in_dir for new PPI files and writes their VADs to daily files in out_dir
+    """
+
+    def __init__(self, in_dir, out_dir, system, prefix='vad', pattern='*.nc', poll_time=2., settle_time=2.,
+                 state_file=None, use_inotify=True, retry_time=60.):
+        """
+        :param in_dir: Directory the PPIs show up in
+        :param out_dir: Directory for the daily VAD files
+        :param system: System to use in lidar_to_vad.var_lookup
+        :param prefix: Prefix for the daily files
+        :param pattern: Only files matching this glob are processed
+        :param poll_time: Seconds between checks for new files
+        :param settle_time: When polling, a file has to go this long without changing before
+                            it's processed
+        :param state_file: File keeping the list of processed files. Defaults to
+                           .vad_processed in out_dir.
+        :param use_inotify: Use inotify if pyinotify is installed
+        :param retry_time: Seconds to wait before trying a file that failed again
+        """
+        self.in_dir = in_dir
+        self.system = system
+        self.pattern = pattern
+        self.poll_time = poll_time
+        self.settle_time = settle_time
+        self.retry_time = retry_time
+
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+
+        if state_file is None:
+            state_file = os.path.join(out_dir, '.vad_processed')
+
+        self.processed = ProcessedSet(state_file)
+        self.writer = lidar_to_vad.DailyVadWriter(out_dir, prefix=prefix, sync=True)
+        self._day = None
+
+        # Number of failed tries and time of the last one for each file, and (with inotify)
+        # the files that still need doing because they weren't ready or failed
+        self._tries = {}
+        self._pending = set()
+
+        self._events = []
+        self._notifier = None
+        if use_inotify and pyinotify is not None:
+            wm = pyinotify.WatchManager()
+            self._notifier = pyinotify.Notifier(wm, default_proc_fun=lambda event: self._events.append(event.pathname),
+                                                timeout=int(poll_time * 1000))
+            # Only files that are done being written (or were moved in whole, like the decoder does)
+            wm.add_watch(in_dir, pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO)
+            logging.info("Watching {} with inotify".format(in_dir))
+        else:
+            logging.info("Polling {} every {} s".format(in_dir, poll_time))
+
+    def _wanted(self, path):
+        return fnmatch.fnmatch(os.path.basename(path), self.pattern) and path not in self.processed
+
+    def _retry_due(self, path):
+        tries, last_try = self._tries.get(path, (0, 0.))
+        return time.time() - last_try >= self.retry_time
+
+    def _new_files(self):
+        """
+        Lists the files in in_dir that haven't been done yet, oldest first
+        """
+        files = [f for f in glob(os.path.join(self.in_dir, self.pattern)) if f not in self.processed]
+        return sorted(files, key=lambda f: (os.path.getmtime(f), f))
+
+    def process(self, path):
+        """
+        Does the VAD for one file and adds it to the daily file. Failures are logged, and
+        the file is only marked as done once it has worked or failed MAX_TRIES times.
+        :return: True if the file is done with
+        """
+        try:
+            u, v, w, hgt, rmse, r_sq, date, elev = lidar_to_vad.process_file(path, self.system)
+
+            # Only keep the current day's files open
+            if self._day is not None and date.date() != self._day:
+                self.writer.close()
+            self._day = date.date()
+
+            if self.writer.has_profile(date, elev):
+                logging.info("Profile for {} is already in {}".format(path, self.writer.filename(date, elev)))
+            else:
+                out_file = self.writer.write(date, elev, u, v, w, hgt, rmse, r_sq)
+                logging.info("{} -> {} ({:.1f} s after the file landed)".format(
+                    path, out_file, time.time() - os.path.getmtime(path)))
+        except Exception:
+            tries = self._tries.get(path, (0, 0.))[0] + 1
+            if tries < MAX_TRIES:
+                logging.exception("Failed to process {} (try {} of {}), trying again in {} s".format(
+                    path, tries, MAX_TRIES, self.retry_time))
+                self._tries[path] = (tries, time.time())
+                return False
+
+            logging.exception("Failed to process {} {} times, giving up on it".format(path, tries))
+
+        self._tries.pop(path, None)
+        self.processed.add(path)
+        return True
+
+    def poll(self):
+        """
+        Processes everything that's new and ready
+        :return: Number of files processed
+        """
+        if self._notifier is not None:
+            if self._notifier.check_events():
+                self._notifier.read_events()
+                self._notifier.process_events()
+
+            # Files from the events are done being written. Anything left over from before
+            # (backlog that wasn't ready or files that failed) gets picked up once it's settled.
+            new = set(f for f in self._events if self._wanted(f))
+            self._events = []
+
+            self._pending = set(f for f in self._pending | new if os.path.exists(f) and self._wanted(f))
+            ready = sorted(f for f in self._pending
+                           if self._retry_due(f) and (f in new or _is_settled(f, self.settle_time)))
+        else:
+            ready = [f for f in self._new_files() if _is_settled(f, self.settle_time) and self._retry_due(f)]
+
+        for f in ready:
+            if self.process(f):
+                self._pending.discard(f)
+            else:
+                self._pending.add(f)
+
+        return len(ready)
+
+    def run(self):
+        """
+        Catches up on whatever showed up while the service wasn't running, then keeps
+        processing new files until it's killed
+        """
+        try:
+            backlog = self._new_files()
+            if backlog:
+                logging.info("Catching up on {} files".format(len(backlog)))
+
+            # Anything still being written gets picked up once it's done
+            for f in backlog:
+                if not _is_settled(f, self.settle_time) or not self.process(f):
+                    self._pending.add(f)
+
+            while True:
+                if self.poll() == 0 and self._notifier is None:
+                    time.sleep(self.poll_time)
+        finally:
+            self.close()
+
+    def close(self):
+        self.writer.close()
+
+        if self._notifier is not None:
+            self._notifier.stop()
+            self._notifier = None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', dest='in_dir', required=True, help='Directory to watch for PPI files')
+    parser.add_argument('-o', dest='out_dir', default=os.getcwd(), help='Directory for the daily VAD files')
+    parser.add_argument('-O', dest='out_prefix', default='vad')
+    parser.add_argument('-s', dest='system', default='mp1')
+    parser.add_argument('--pattern', dest='pattern', default='*.nc', help='Glob for the files to process')
+    parser.add_argument('--poll', dest='poll_time', type=float, default=2.,
+                        help='Seconds between checks for new files')
+    parser.add_argument('--settle', dest='settle_time', type=float, default=2.,
+                        help='When polling, wait until a file has not changed for this many seconds')
+    parser.add_argument('--state', dest='state_file', default=None,
+                        help='File listing the processed files (default: .vad_processed in the output directory)')
+    parser.add_argument('--no-inotify', dest='use_inotify', action='store_false',
+                        help='Poll the directory even if pyinotify is installed')
+    parser.add_argument('--retry', dest='retry_time', type=float, default=60.,
+                        help='Seconds to wait before trying a file that failed again')
+    parser.add_argument('-v', '--verbose', dest='verbose', action='store_true')
+    args = parser.parse_args()
+
+    if args.verbose:
+        logging.basicConfig(format='%(asctime)s:%(levelname)s:%(message)s', level=logging.DEBUG)
+    else:
+        logging.basicConfig(format='%(asctime)s:%(levelname)s:%(message)s', level=logging.INFO)
+
+    # Make sure the daily files get closed properly when the service is stopped
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    daemon = VadDaemon(args.in_dir, args.out_dir, args.system, prefix=args.out_prefix, pattern=args.pattern,
+                       poll_time=args.poll_time, settle_time=args.settle_time, state_file=args.state_file,
+                       use_inotify=args.use_inotify, retry_time=args.retry_time)
+    daemon.run()